@@ -1,4 +1,5 @@
 import os
+import copy
 import uuid
 import functools
 import asyncio
@@ -15,6 +16,7 @@ import lidarrmetadata
 from lidarrmetadata import config
 from lidarrmetadata import provider
 from lidarrmetadata import util
+from lidarrmetadata.cache import SingleFlight
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -69,30 +71,242 @@ async def get_overview(links, mbid=None):
 
     return overview, expiry
 
-# Decorator to cache in redis and postgres
-def postgres_cache(cache):
+async def acquire_lease(key):
+    """
+    Tries to take a short redis lease so only one worker rebuilds a cache entry
+    :param key: Lease key
+    :return: True if we hold the lease (or leases are disabled), False if another worker does
+    """
+    if not CONFIG.USE_CACHE or not CONFIG.CACHE_LEASE_TTL:
+        return True
+
+    try:
+        await util.CACHE.add(key, True, ttl=CONFIG.CACHE_LEASE_TTL)
+        return True
+    except ValueError:
+        # Key already exists
+        return False
+    except Exception as error:
+        logger.error(f'Could not take lease {key}: {error}')
+        return True
+
+async def release_lease(key):
+    if not CONFIG.USE_CACHE or not CONFIG.CACHE_LEASE_TTL:
+        return
+
+    try:
+        await util.CACHE.delete(key)
+    except Exception as error:
+        logger.error(f'Could not release lease {key}: {error}')
+
+async def wait_for_lease(cache, mbid, key, interval=0.25):
+    """
+    Waits for the worker holding a lease to store its result
+    :return: (value, expiry) stored by the lease holder or (None, None) if it gave up
+    """
+    deadline = timer() + CONFIG.CACHE_LEASE_TTL
+    while timer() < deadline:
+        await asyncio.sleep(interval)
+
+        cached, expiry = await cache.get(mbid)
+        if cached and expiry > provider.utcnow():
+            return cached, expiry
+
+        if not await util.CACHE.exists(key):
+            break
+
+    return None, None
+
+# Keep references to background refreshes so they aren't garbage collected
+_background_refreshes = set()
+
+def refresh_in_background(inflight, mbid, rebuild, *args, **kwargs):
+    """
+    Schedules a rebuild of a stale cache entry unless one is already running
+    """
+    if mbid in inflight:
+        return
+
+    def done(task):
+        _background_refreshes.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f'Background refresh of {mbid} failed: {task.exception()!r}')
+
+    task = inflight.start(mbid, rebuild, *args, **kwargs)
+    _background_refreshes.add(task)
+    task.add_done_callback(done)
+
+# Decorator to cache in memory and postgres
+def postgres_cache(cache, local=None):
     def decorator(function):
+        inflight = SingleFlight()
+
+        def lease_key(mbid):
+            return f'{function.__name__}Lease:{mbid}'
+
+        async def rebuild(*args, **kwargs):
+            mbid = args[0]
+            lease_key = wrapper.__lease_key__(mbid)
+
+            leased = await acquire_lease(lease_key)
+            if not leased:
+                cached, expiry = await wait_for_lease(cache, mbid, lease_key)
+                if cached:
+                    return cached, expiry
+
+            try:
+                now = provider.utcnow()
+                result, expiry = await function(*args, **kwargs)
+                ttl = (expiry - now).total_seconds()
+
+                await cache.set(mbid, result, ttl=ttl)
+                return result, expiry
+            finally:
+                if leased:
+                    await release_lease(lease_key)
+
         @functools.wraps(function)
         async def wrapper(*args, **kwargs):
-            
+
             mbid = args[0]
-            
+
+            if local is not None:
+                cached, expiry = local.get(mbid)
+                if cached is not None:
+                    return cached, expiry
+
             now = provider.utcnow()
 
             cached, expiry = await cache.get(mbid)
             if cached and expiry > now:
+                if local is not None:
+                    local.set(mbid, cached, expiry)
                 return cached, expiry
-            
-            result, expiry = await function(*args, **kwargs)
-            ttl = (expiry - now).total_seconds()
-            
-            await cache.set(mbid, result, ttl=ttl)
-            return result, expiry
+
+            # Serve recently expired entries straight away with a short TTL and refresh them in the background
+            if cached and (now - expiry).total_seconds() < CONFIG.CACHE_STALE_GRACE:
+                refresh_in_background(inflight, mbid, rebuild, *args, **kwargs)
+                return cached, now + timedelta(seconds=CONFIG.CACHE_TTL['stale'])
+
+            # Concurrent misses for the same mbid share a single rebuild
+            built = await inflight.run(mbid, rebuild, *args, **kwargs)
+            if built is None:
+                # Joined a get_cached_batch build that didn't return mbid, e.g. an old id to redirect
+                built = await rebuild(*args, **kwargs)
+            result, expiry = built
+
+            if local is not None:
+                local.set(mbid, result, expiry)
+
+            # Every waiter gets the same result so hand out copies that are safe to modify
+            return copy.copy(result), expiry
 
         wrapper.__cache__ = cache
+        wrapper.__local__ = local
+        wrapper.__inflight__ = inflight
+        wrapper.__rebuild__ = rebuild
+        wrapper.__lease_key__ = lease_key
         return wrapper
     return decorator
 
+async def rebuild_batch(mbids, function, multi_function):
+    """
+    Batched equivalent of a postgres_cache rebuild. Takes a lease on each mbid, waits for the
+    workers holding any we couldn't get and builds the rest with a single call to multi_function
+    :return: Dict of mbid to (result, expiry) for the mbids that were found
+    """
+    cache = function.__cache__
+    lease_keys = {mbid: function.__lease_key__(mbid) for mbid in mbids}
+
+    leased = await asyncio.gather(*(acquire_lease(lease_keys[mbid]) for mbid in mbids))
+    leased = [mbid for mbid, lease in zip(mbids, leased) if lease]
+
+    results = {}
+    others = [mbid for mbid in mbids if mbid not in leased]
+    waited = await asyncio.gather(*(wait_for_lease(cache, mbid, lease_keys[mbid]) for mbid in others))
+    results.update((mbid, result) for mbid, result in zip(others, waited) if result[0])
+
+    try:
+        # Including any whose lease holder gave up
+        build = [mbid for mbid in mbids if mbid not in results]
+        if build:
+            built = await multi_function(build) or []
+            built = {result['id']: (result, expiry) for result, expiry in built}
+
+            found = [mbid for mbid in build if mbid in built]
+            if found:
+                await cache.multi_set_expiring([(mbid, *built[mbid]) for mbid in found])
+                results.update((mbid, built[mbid]) for mbid in found)
+    finally:
+        await asyncio.gather(*(release_lease(lease_keys[mbid]) for mbid in leased))
+
+    return results
+
+async def get_cached_batch(function, multi_function, mbids, return_exceptions=False):
+    """
+    Batched equivalent of calling a postgres_cache decorated function for each of mbids.
+
+    Everything not held in memory is read from the cache in one query, and all the misses
+    are built with a single call to multi_function and written back in one statement. Misses
+    share the function's SingleFlight and leases, so mbids already being built here or by
+    another worker are waited for instead. Any mbids multi_function doesn't return (e.g. old
+    ids that need redirecting) fall back to calling function itself.
+    :param function: postgres_cache decorated function
+    :param multi_function: Function building (result, expiry) tuples for a list of mbids
+    :param mbids: List of mbids
+    :param return_exceptions: Return exceptions in place of results rather than raising, as for asyncio.gather
+    :return: List of (result, expiry) tuples in the same order as mbids
+    """
+    cache = function.__cache__
+    local = function.__local__
+    now = provider.utcnow()
+
+    results = {}
+    remaining = []
+    for mbid in dict.fromkeys(mbids):
+        cached, expiry = local.get(mbid) if local is not None else (None, None)
+        if cached is not None:
+            results[mbid] = (cached, expiry)
+        else:
+            remaining.append(mbid)
+
+    missing = []
+    if remaining:
+        for mbid, (cached, expiry) in zip(remaining, await cache.multi_get(remaining)):
+            if cached and expiry > now:
+                if local is not None:
+                    local.set(mbid, cached, expiry)
+                results[mbid] = (cached, expiry)
+            elif cached and (now - expiry).total_seconds() < CONFIG.CACHE_STALE_GRACE:
+                refresh_in_background(function.__inflight__, mbid, function.__rebuild__, mbid)
+                results[mbid] = (cached, now + timedelta(seconds=CONFIG.CACHE_TTL['stale']))
+            else:
+                missing.append(mbid)
+
+    if missing:
+        built = await function.__inflight__.run_many(missing, rebuild_batch, function, multi_function)
+
+        errors = [(mbid, built[mbid]) for mbid in missing if isinstance(built[mbid], BaseException)]
+        if errors and not return_exceptions:
+            raise errors[0][1]
+        results.update(errors)
+
+        found = [mbid for mbid in missing if built[mbid] is not None and mbid not in results]
+        for mbid in found:
+            if local is not None:
+                local.set(mbid, *built[mbid])
+            results[mbid] = built[mbid]
+
+        not_found = [mbid for mbid in missing if built[mbid] is None]
+        fallbacks = await asyncio.gather(*[function(mbid) for mbid in not_found],
+                                         return_exceptions=return_exceptions)
+        results.update(zip(not_found, fallbacks))
+
+    # Hand out copies in case the same mbid was requested more than once
+    return [results[mbid] if isinstance(results[mbid], BaseException)
+            else (copy.copy(results[mbid][0]), results[mbid][1])
+            for mbid in mbids]
+
 class ArtistNotFoundException(Exception):
     def __init__(self, mbid):
         super().__init__(f"Artist not found: {mbid}")
@@ -101,7 +315,7 @@ class ArtistNotFoundException(Exception):
 class MissingProviderException(Exception):
     """ Thown when we can't cope without a provider """
 
-@postgres_cache(util.ARTIST_CACHE)
+@postgres_cache(util.ARTIST_CACHE, util.ARTIST_MEMORY_CACHE)
 async def get_artist_info(mbid):
 
     artists = await get_artist_info_multi([mbid])
@@ -115,6 +329,13 @@ async def get_artist_info(mbid):
     
     return artists[0]
 
+async def get_artist_info_batch(mbids, return_exceptions=False):
+    """
+    Gets cached artist info for a list of mbids with a single cache read and MB DB query
+    :return: List of (artist, expiry) in the same order as mbids
+    """
+    return await get_cached_batch(get_artist_info, get_artist_info_multi, mbids, return_exceptions)
+
 async def get_artist_info_multi(mbids):
     
     start = timer()
@@ -191,8 +412,8 @@ async def get_release_group_artists(release_group):
     
     start = timer()
     
-    results = await asyncio.gather(*[get_artist_info(gid) for gid in release_group['artistids']])
-                                   
+    results = await get_artist_info_batch(release_group['artistids'])
+
     artists = [result[0] for result in results]
     expiry = min([result[1] for result in results])
     
@@ -205,7 +426,7 @@ class ReleaseGroupNotFoundException(Exception):
         super().__init__(f"Album not found: {mbid}")
         self.mbid = mbid
 
-@postgres_cache(util.ALBUM_CACHE)
+@postgres_cache(util.ALBUM_CACHE, util.ALBUM_MEMORY_CACHE)
 async def get_release_group_info_basic(mbid):
     
     release_groups = await get_release_group_info_multi([mbid])
@@ -272,3 +493,150 @@ async def get_release_group_info(mbid):
     del release_group['artistids']
     
     return release_group, min(rg_expiry, artist_expiry)
+
+async def get_release_group_info_batch(mbids, return_exceptions=False):
+    """
+    Gets full album info for a list of mbids, batching both the album and artist lookups
+    :return: List of (album, expiry) in the same order as mbids
+    """
+    release_groups = await get_cached_batch(get_release_group_info_basic, get_release_group_info_multi,
+                                            mbids, return_exceptions)
+    return await add_release_group_artists(release_groups, return_exceptions)
+
+async def add_release_group_artists(release_groups, return_exceptions=False):
+    """
+    Replaces artistids with the artists themselves for a list of albums, looking the
+    artists up in a single batch
+    :param release_groups: List of (release_group, expiry) tuples, or exceptions which are passed through
+    :return: List of (album, expiry) tuples
+    """
+    artistids = [artistid
+                 for result in release_groups if not isinstance(result, BaseException)
+                 for artistid in result[0]['artistids']]
+    artists = await get_artist_info_batch(artistids, return_exceptions)
+    artists = dict(zip(artistids, artists))
+
+    results = []
+    for result in release_groups:
+        if isinstance(result, BaseException):
+            results.append(result)
+            continue
+
+        release_group, expiry = result
+        album_artists = [artists[artistid] for artistid in release_group['artistids']]
+        error = next((artist for artist in album_artists if isinstance(artist, BaseException)), None)
+        if error:
+            results.append(error)
+            continue
+
+        release_group = copy.copy(release_group)
+        release_group['artists'] = [artist[0] for artist in album_artists]
+        del release_group['artistids']
+        results.append((release_group, min([expiry] + [artist[1] for artist in album_artists])))
+
+    return results
+
+async def get_artist_info_with_albums(mbid):
+    """
+    Gets the full /artist response
+    :return: (artist, expiry) with the artist's albums under 'Albums'
+    """
+    (artist, expiry), albums = await asyncio.gather(get_artist_info(mbid), get_artist_albums(mbid))
+    artist['Albums'] = albums
+    return artist, expiry
+
+def response_key(path):
+    """
+    Key for a rendered response, kept separate for each release and root path since the
+    output format can change between them
+    """
+    return f'{lidarrmetadata.__version__}:{CONFIG.ROOT_PATH}{path}'
+
+def render_response(value):
+    """
+    Renders a response body the same way as the app's jsonify
+    """
+    return util.json_dumps(value, default=util.JSONEncoder().default)
+
+async def set_cached_responses(items):
+    """
+    Renders and stores response bodies
+    :param items: List of (path, value, expiry) tuples
+    :return: List of rendered bodies
+    """
+    now = provider.utcnow()
+    bodies = [render_response(value) for _, value, _ in items]
+    await util.RESPONSE_CACHE.multi_set_expiring([(response_key(path), body, expiry)
+                                                  for (path, _, expiry), body in zip(items, bodies)
+                                                  if expiry > now])
+    return bodies
+
+async def iterate_artist_release_group_ids(mbids, chunk_size=10000):
+    """
+    Yields the albums crediting any of a list of artists in lists of up to chunk_size, so a
+    prolific artist's albums never all have to be in memory. Their /album responses include
+    the artists so have to be expired along with them
+    """
+    musicbrainz = provider.get_providers_implementing(provider.MusicbrainzDbProvider)
+    if not mbids or not musicbrainz:
+        return
+
+    chunk = []
+    async for mbid in musicbrainz[0].iterate_artist_release_group_ids(list(mbids)):
+        chunk.append(mbid)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+# Concurrent misses for the same response share a single build
+_response_inflight = SingleFlight()
+
+async def build_response(path, function, *args):
+    value, expiry = await function(*args)
+    body = (await set_cached_responses([(path, value, expiry)]))[0]
+    return body, expiry
+
+async def get_cached_response(path, function, *args):
+    """
+    Gets the rendered response body for path, building and storing it using function if missing
+    :param function: Function returning the (value, expiry) to render
+    :return: (body, expiry)
+    """
+    body, expiry = await util.RESPONSE_CACHE.get(response_key(path))
+    if body is not None and expiry > provider.utcnow():
+        return body, expiry
+
+    return await _response_inflight.run(path, build_response, path, function, *args)
+
+async def get_artist_response(mbid):
+    return await get_cached_response(f'/artist/{mbid}', get_artist_info_with_albums, mbid)
+
+async def get_release_group_response(mbid):
+    return await get_cached_response(f'/album/{mbid}', get_release_group_info, mbid)
+
+async def set_artist_responses(artists):
+    """
+    Stores rendered /artist responses for freshly built artists
+    :param artists: List of (artist, expiry) tuples as returned by get_artist_info_multi
+    """
+    albums = await asyncio.gather(*(get_artist_albums(artist['id']) for artist, _ in artists))
+
+    items = []
+    for (artist, expiry), artist_albums in zip(artists, albums):
+        artist = copy.copy(artist)
+        artist['Albums'] = artist_albums
+        items.append((f'/artist/{artist["id"]}', artist, expiry))
+
+    await set_cached_responses(items)
+
+async def set_release_group_responses(release_groups):
+    """
+    Stores rendered /album responses for freshly built albums
+    :param release_groups: List of (release_group, expiry) tuples as returned by get_release_group_info_multi
+    """
+    results = await add_release_group_artists(release_groups, return_exceptions=True)
+    items = [(f'/album/{result[0]["id"]}', *result) for result in results if not isinstance(result, BaseException)]
+    await set_cached_responses(items)
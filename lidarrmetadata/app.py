@@ -21,8 +21,10 @@ import Levenshtein
 
 import lidarrmetadata
 from lidarrmetadata import api
+from lidarrmetadata import cache
 from lidarrmetadata import chart
 from lidarrmetadata import config
+from lidarrmetadata import invalidation
 from lidarrmetadata import provider
 from lidarrmetadata import util
 
@@ -33,6 +35,8 @@ logger.info('Have app logger')
 
 app = Quart(__name__)
 app.config.from_object(config.get_config())
+app.json_encoder = util.JSONEncoder
+app.json_decoder = util.JSONDecoder
 
 if app.config['SENTRY_DSN']:
     if app.config['SENTRY_REDIS_HOST'] is not None:
@@ -77,6 +81,12 @@ def no_cache(func):
         return response
     return wrapper
 
+def json_response(body):
+    """
+    Wraps an already rendered JSON body in a response
+    """
+    return app.response_class(body, content_type=app.config['JSONIFY_MIMETYPE'])
+
 def get_search_query():
     """
     Search for a track
@@ -159,26 +169,30 @@ async def get_artist_info_route(mbid):
     if uuid_validation_response:
         return uuid_validation_response
     
-    artist_task = asyncio.create_task(api.get_artist_info(mbid))
-    albums_task = asyncio.create_task(api.get_artist_albums(mbid))
+    primary_types = request.args.get('primTypes', None)
+    secondary_types = request.args.get('secTypes', None)
+    release_statuses = request.args.get('releaseStatuses', None)
 
-    artist, expiry = await artist_task
+    util.ARTIST_HITS.record(mbid)
+
+    # Serve the pre-rendered response unless the albums need filtering
+    if not (primary_types or secondary_types or release_statuses):
+        body, expiry = await api.get_artist_response(mbid)
+        return await add_cache_control_header(json_response(body), expiry)
+
+    artist, expiry = await api.get_artist_info_with_albums(mbid)
+    albums = artist['Albums']
 
-    albums = await albums_task
-        
     # Filter release group types
     # This will soon happen client side but keep around until api version is bumped for older clients
-    primary_types = request.args.get('primTypes', None)
     if primary_types:
         primary_types = primary_types.split('|')
         albums = list(filter(lambda release_group: release_group.get('Type') in primary_types, albums))
-    secondary_types = request.args.get('secTypes', None)
     if secondary_types:
         secondary_types = set(secondary_types.split('|'))
         albums = list(filter(lambda release_group: (release_group['SecondaryTypes'] == [] and 'Studio' in secondary_types)
                              or secondary_types.intersection(release_group.get('SecondaryTypes')),
                              albums))
-    release_statuses = request.args.get('releaseStatuses', None)
     if release_statuses:
         release_statuses = set(release_statuses.split('|'))
         albums = list(filter(lambda album: release_statuses.intersection(album.get('ReleaseStatuses')),
@@ -195,8 +209,9 @@ async def refresh_artist_route(mbid):
         return uuid_validation_response
 
     await util.ARTIST_CACHE.set(mbid, None)
-    base_url = app.config['CLOUDFLARE_URL_BASE'] + '/' +  app.config['ROOT_PATH'].lstrip('/').rstrip('/')
-    await invalidate_cloudflare([f'{base_url}/artist/{mbid}'])
+    await util.RESPONSE_CACHE.delete(api.response_key(f'/artist/{mbid}'))
+    util.ARTIST_MEMORY_CACHE.delete(mbid)
+    await invalidation.invalidate_cloudflare([f'{invalidation.cloudflare_base_url()}/artist/{mbid}'])
     return jsonify(success=True)
 
 
@@ -206,10 +221,12 @@ async def get_release_group_info_route(mbid):
     uuid_validation_response = validate_mbid(mbid)
     if uuid_validation_response:
         return uuid_validation_response
+
+    util.ALBUM_HITS.record(mbid)
     
-    output, expiry = await api.get_release_group_info(mbid)
+    body, expiry = await api.get_release_group_response(mbid)
     
-    return await add_cache_control_header(jsonify(output), expiry)
+    return await add_cache_control_header(json_response(body), expiry)
 
 @app.route('/album/<mbid>/refresh', methods=['POST'])
 async def refresh_release_group_route(mbid):
@@ -218,8 +235,9 @@ async def refresh_release_group_route(mbid):
         return uuid_validation_response
 
     await util.ALBUM_CACHE.set(mbid, None)
-    base_url = app.config['CLOUDFLARE_URL_BASE'] + '/' +  app.config['ROOT_PATH'].lstrip('/').rstrip('/')
-    await invalidate_cloudflare([f'{base_url}/album/{mbid}'])
+    await util.RESPONSE_CACHE.delete(api.response_key(f'/album/{mbid}'))
+    util.ALBUM_MEMORY_CACHE.delete(mbid)
+    await invalidation.invalidate_cloudflare([f'{invalidation.cloudflare_base_url()}/album/{mbid}'])
     return jsonify(success=True)
 
 @app.route('/recent/artist', methods=['GET'])
@@ -241,6 +259,21 @@ async def get_recently_updated_albums():
     updated = await util.ALBUM_CACHE.get_recently_updated(since, 10000)
     return jsonify(updated)
 
+@app.route('/cache/stats', methods=['GET'])
+@no_cache
+async def get_cache_stats():
+    return jsonify({'artist': util.ARTIST_MEMORY_CACHE.stats(),
+                    'album': util.ALBUM_MEMORY_CACHE.stats()})
+
+@app.route('/cache/tables', methods=['GET'])
+@no_cache
+async def get_cache_tables():
+    if request.headers.get('authorization') != app.config['INVALIDATE_APIKEY']:
+        return jsonify('Unauthorized'), 401
+
+    results = await asyncio.gather(*(item.table_stats() for item in util.POSTGRES_CACHES))
+    return jsonify({item.db_table: result for item, result in zip(util.POSTGRES_CACHES, results)})
+
 @app.route('/chart/<name>/<type_>/<selection>')
 async def chart_route(name, type_, selection):
     """
@@ -317,6 +350,17 @@ async def search_album():
 
     return await add_cache_control_header(jsonify(albums), validity)
 
+def get_search_result(result, score, not_found):
+    """
+    Converts a batched lookup result into a (result, score, validity) tuple, skipping hits
+    that no longer exist
+    """
+    if isinstance(result, not_found):
+        return None, -1, provider.utcnow()
+    if isinstance(result, BaseException):
+        raise result
+    return result[0], score, result[1]
+
 async def get_album_search_results(query, limit, include_tracks, artist_name):
     search_providers = provider.get_providers_implementing(provider.AlbumNameSearchMixin)
     
@@ -325,15 +369,11 @@ async def get_album_search_results(query, limit, include_tracks, artist_name):
         search_results = await search_providers[0].search_album_name(query, artist_name=artist_name, limit=limit)
         logger.debug(f"Got album search results in {(timer() - start) * 1000:.0f}ms ")
 
-        async def get_search_result(item):
-            try:
-                result, validity = await api.get_release_group_info(item['Id'])
-                return result, item['Score'], validity
-            except api.ReleaseGroupNotFoundException:
-                return None, -1, provider.utcnow()
-            
-        
-        results = await asyncio.gather(*[get_search_result(item) for item in search_results])
+        # Hydrate all the hits together, keeping the search ordering
+        albums = await api.get_release_group_info_batch([item['Id'] for item in search_results],
+                                                        return_exceptions=True)
+        results = [get_search_result(album, item['Score'], api.ReleaseGroupNotFoundException)
+                   for album, item in zip(albums, search_results)]
         albums = [result[0] for result in results if result[0]]
 
         # Current versions of lidarr will fail trying to parse the tracks contained in releases
@@ -400,14 +440,9 @@ async def get_artist_search_results(query, limit):
     # TODO Prefer certain providers?
     artist_ids = await search_providers[0].search_artist_name(query, limit=limit)
 
-    async def get_search_result(id, score):
-        try:
-            result, validity = await api.get_artist_info(id)
-            return result, score, validity
-        except api.ArtistNotFoundException:
-            return None, -1, provider.utcnow()
-
-    results = await asyncio.gather(*[get_search_result(item['Id'], item['Score']) for item in artist_ids])
+    artists = await api.get_artist_info_batch([item['Id'] for item in artist_ids], return_exceptions=True)
+    results = [get_search_result(artist, item['Score'], api.ArtistNotFoundException)
+               for artist, item in zip(artists, artist_ids)]
 
     artists = [result[0] for result in results if result[0]]
     scores = [result[1] for result in results if result[0]]
@@ -453,7 +488,7 @@ async def search_fingerprint():
     album_provider = provider.get_providers_implementing(provider.ReleaseGroupByIdMixin)[0]
     album_ids = await album_provider.get_release_groups_by_recording_ids(ids)
 
-    results = await asyncio.gather(*[api.get_release_group_info(id) for id in album_ids])
+    results = await api.get_release_group_info_batch(album_ids)
     albums = [result[0] for result in results]
     validity = min([result[1] for result in results] or [provider.utcnow()])
 
@@ -610,7 +645,7 @@ async def invalidate_cache():
     
     ## this is used as a prefix in various places to make sure
     ## we keep cache for different metadata versions separate
-    base_url = app.config['CLOUDFLARE_URL_BASE'] + '/' +  app.config['ROOT_PATH'].lstrip('/').rstrip('/')
+    base_url = invalidation.cloudflare_base_url()
     
     ## Use a cache key to make sure we don't trigger this in parallel
     invalidation_in_progress_key = base_url + 'CacheInvalidationInProgress'
@@ -631,30 +666,18 @@ async def invalidate_cache():
 
         ## Get all the artists/albums that need updating
         cache_users = provider.get_providers_implementing(provider.InvalidateCacheMixin)
-        for cache_user in cache_users:
-            result = await cache_user.invalidate_cache(base_url, since)
-
+        results = await asyncio.gather(*(cache_user.invalidate_cache(base_url, since) for cache_user in cache_users))
+        for result in results:
             artists = artists.union(result['artists'])
             albums = albums.union(result['albums'])
             spotify_artists = spotify_artists.union(result['spotify_artists'])
             spotify_albums = spotify_albums.union(result['spotify_albums'])
 
-        ## Invalidate all the local caches
-        ## Use set rather than expires so that we add entries for new items also
-        await asyncio.gather(
-            util.ARTIST_CACHE.multi_set([(artist, None) for artist in artists], ttl=0, timeout=None),
-            util.ALBUM_CACHE.multi_set([(album, None) for album in albums], ttl=0, timeout=None),
-            util.SPOTIFY_CACHE.multi_set([(spotify_artist, None) for spotify_artist in spotify_artists], ttl=0, timeout=None),
-            util.SPOTIFY_CACHE.multi_set([(spotify_album, None) for spotify_album in spotify_albums], ttl=0, timeout=None)
-        )
+        await invalidation.expire_entities(artists, albums, spotify_artists, spotify_albums)
 
         ## Invalidate cloudflare cache
-        invalidated = ([f'{base_url}/artist/{artist}' for artist in artists] + 
-            [f'{base_url}/album/{album}' for album in albums] +
-            [f'{base_url}/spotify/artist/{spotify_artist}' for spotify_artist in spotify_artists] +
-            [f'{base_url}/spotify/album/{spotify_album}' for spotify_album in spotify_albums]
-        )
-        await invalidate_cloudflare(invalidated)
+        invalidated = invalidation.cloudflare_urls(artists, albums, spotify_artists, spotify_albums)
+        await invalidation.invalidate_cloudflare(invalidated)
     
     finally:
         await util.CACHE.delete(invalidation_in_progress_key)
@@ -665,33 +688,6 @@ async def invalidate_cache():
     
     return jsonify(invalidated)
 
-async def invalidate_cloudflare(files):
-    
-    zoneid = app.config['CLOUDFLARE_ZONE_ID']
-    if not zoneid:
-        return
-    
-    url = f'https://api.cloudflare.com/client/v4/zones/{zoneid}/purge_cache'
-    headers = {'X-Auth-Email': app.config['CLOUDFLARE_AUTH_EMAIL'],
-               'X-Auth-Key': app.config['CLOUDFLARE_AUTH_KEY'],
-               'Content-Type': 'application/json'}
-    
-    async with aiohttp.ClientSession() as session:
-        # cloudflare only accepts 30 files at a time
-        for i in range(0, len(files), 30):
-            data = {'files': files[i:i+30]}
-            retries = 2
-            
-            while retries > 0:
-                async with session.post(url, headers=headers, json=data) as r:
-                    logger.info(await r.text())
-                    json = await r.json()
-
-                    if json.get('success', False):
-                        break
-                    
-                    retries -= 1
-
 @app.route('/spotify/auth')
 @no_cache
 async def handle_spotify_auth_redirect():
@@ -733,6 +729,64 @@ async def handle_spotify_token_renew():
     except aiohttp.ClientResponseError as error:
         abort(error.status, error.message)
 
+def get_database_pools():
+    """
+    Gets everything holding an asyncpg pool
+    """
+    return util.POSTGRES_CACHES + provider.get_providers_implementing(provider.MusicbrainzDbProvider)
+
+async def check_database_pools():
+    interval = app.config['DB_HEALTH_CHECK_INTERVAL']
+    while True:
+        await asyncio.sleep(interval)
+        mb_providers = provider.get_providers_implementing(provider.MusicbrainzDbProvider)
+        results = await asyncio.gather(cache.check_shared_pools(),
+                                       *(item.check_connections() for item in mb_providers),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f'Database health check failed: {result!r}')
+
+async def flush_hit_counters():
+    for counter in (util.ARTIST_HITS, util.ALBUM_HITS):
+        try:
+            await counter.flush()
+        except Exception as error:
+            # Only a sample of hits so fine to drop them
+            logger.error(f'Failed to write hit counts: {error!r}')
+
+async def write_hit_counts():
+    interval = app.config['CACHE_HIT_FLUSH_INTERVAL']
+    while True:
+        await asyncio.sleep(interval)
+        await flush_hit_counters()
+
+@app.before_serving
+async def warm_up_database_pools():
+    results = await asyncio.gather(*(item.warm_up() for item in get_database_pools()),
+                                   return_exceptions=True)
+    for result in results:
+        # Carry on regardless, the pool will be created when it is first needed instead
+        if isinstance(result, Exception):
+            logger.error(f'Failed to warm up database pool: {result!r}')
+
+    if app.config['DB_HEALTH_CHECK_INTERVAL']:
+        app.health_check_task = asyncio.create_task(check_database_pools())
+
+    if app.config['CACHE_HIT_SAMPLE_RATE']:
+        app.hit_count_task = asyncio.create_task(write_hit_counts())
+
+@app.after_serving
+async def stop_database_health_checks():
+    for name in ('health_check_task', 'hit_count_task'):
+        task = getattr(app, name, None)
+        if task:
+            task.cancel()
+
+    await flush_hit_counters()
+
+    await cache.close_shared_pools()
+
 @app.after_serving
 async def run_async_del():
     async_providers = provider.get_providers_implementing(provider.AsyncDel)
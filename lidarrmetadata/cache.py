@@ -1,10 +1,14 @@
 """
 Defines the custom redis cache backend which compresses pickle dumps
 """
+import collections
+import copy
 import functools
 import hashlib
 import logging
 import contextlib
+import marshal
+import random
 import zlib
 import asyncio
 import asyncpg
@@ -39,15 +43,87 @@ class CompressionSerializer(BaseSerializer):
             return None
         return pickle.loads(zlib.decompress(value))
     
-class ExpirySerializer(PickleSerializer):
+class VersionedSerializer(BaseSerializer):
     """
-    Allows an expiry time to be returned at the same time as the value
+    Compact binary format with a one byte header recording the format version, codec
+    and whether the payload is zlib compressed.
+
+    Values the codec can't represent (e.g. datetimes with marshal) are stored with pickle
+    instead, and rows written by PickleSerializer, which always start with the pickle
+    PROTO opcode 0x80, are still read so existing caches don't need migrating.
+
+    Compression is off by default as zlib costs more CPU than it saves on typical artist
+    and album documents. Set compress_threshold to compress values at least that long.
     """
-    
+
     DEFAULT_ENCODING = None
 
+    VERSION = 1
+
+    # marshal's default format can change between python versions, so the format written is
+    # pinned and gets its own codec id. Codec 1 was marshal in the writer's default format
+    MARSHAL_VERSION = 4
+
+    CODECS = {
+        'pickle': (0, pickle.dumps, pickle.loads),
+        'marshal': (2, lambda value: marshal.dumps(value, VersionedSerializer.MARSHAL_VERSION), marshal.loads)
+    }
+
+    LEGACY_LOADS = {
+        1: marshal.loads
+    }
+
+    COMPRESSED = 0x08
+
+    def __init__(self, *args, codec='marshal', compress_threshold=None, compress_level=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = codec
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self._codecs = {codec_id: loads for codec_id, _, loads in self.CODECS.values()}
+        self._codecs.update(self.LEGACY_LOADS)
+
+    def dumps(self, value):
+        codec_id, dumps, _ = self.CODECS[self.codec]
+        try:
+            data = dumps(value)
+        except ValueError:
+            codec_id, dumps, _ = self.CODECS['pickle']
+            data = dumps(value)
+
+        header = self.VERSION << 4 | codec_id
+        if self.compress_threshold is not None and len(data) >= self.compress_threshold:
+            data = zlib.compress(data, self.compress_level)
+            header |= self.COMPRESSED
+
+        return bytes((header,)) + data
+
     def loads(self, value):
         if value is None:
+            return None
+
+        header = value[0]
+        if header == 0x80:
+            return pickle.loads(value)
+
+        version = header >> 4
+        if version != self.VERSION:
+            raise ValueError(f'Unknown cache value format version {version}')
+
+        data = value[1:]
+        if header & self.COMPRESSED:
+            data = zlib.decompress(data)
+
+        return self._codecs[header & 0x07](data)
+
+class ExpirySerializer(VersionedSerializer):
+    """
+    Allows an expiry time to be returned at the same time as the value
+    """
+
+    def loads(self, value):
+        # Keys multi_get didn't find come back as a row of nulls
+        if value is None or value[0] is None:
             return None, datetime.datetime.now(datetime.timezone.utc)
         return super().loads(value[0]), value[1]
 
@@ -63,6 +139,88 @@ def conn(func):
 
     return wrapper
 
+async def check_pool(pool, timeout=5):
+    """
+    Runs a trivial query on one idle connection in an asyncpg pool, terminating it if it
+    fails so the pool replaces it. Only one connection is held at a time so requests aren't
+    kept waiting; connections left idle are closed by the pool's max_inactive_connection_lifetime
+    :param pool: asyncpg pool
+    :param timeout: Seconds to wait for the connection
+    :return: Number of connections terminated
+    """
+    if not pool.get_idle_size():
+        # Every connection is busy so the database is clearly reachable
+        return 0
+
+    connection = await pool.acquire(timeout=timeout)
+    try:
+        await connection.fetchval('SELECT 1;', timeout=timeout)
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as error:
+        logger.warning(f'Terminating broken connection: {error!r}')
+        connection.terminate()
+        return 1
+    finally:
+        await pool.release(connection)
+
+    return 0
+
+# asyncpg pools shared by every PostgresBackend in the process, keyed by DSN
+_POOLS = {}
+_POOLS_LOCK = None
+
+async def get_shared_pool(host, port, user, password, database, loop=None, **pool_config):
+    """
+    Gets the process wide pool for a database, creating it if needed. The pool_config
+    of whichever caller creates the pool is used
+    """
+    global _POOLS_LOCK
+    if _POOLS_LOCK is None:
+        _POOLS_LOCK = asyncio.Lock()
+
+    dsn = f'postgresql://{user}@{host}:{port}/{database}'
+    async with _POOLS_LOCK:
+        if dsn not in _POOLS:
+            logger.debug(f'Initializing pool for {dsn}')
+            _POOLS[dsn] = await asyncpg.create_pool(host = host,
+                                                    port = port,
+                                                    user = user,
+                                                    password = password,
+                                                    database = database,
+                                                    loop = loop,
+                                                    statement_cache_size=0,
+                                                    **pool_config)
+        return _POOLS[dsn]
+
+async def check_shared_pools(timeout=5):
+    """
+    Checks an idle connection in each shared pool, replacing it if broken
+    :return: Number of connections replaced
+    """
+    return sum([await check_pool(pool, timeout) for pool in list(_POOLS.values())])
+
+async def close_shared_pools():
+    for dsn in list(_POOLS.keys()):
+        await _POOLS.pop(dsn).close()
+
+@contextlib.asynccontextmanager
+async def transaction(*caches):
+    """
+    Runs operations on several caches in one connection and transaction by passing the
+    yielded connection as _conn. The caches must all be in the same database. Yields None,
+    which the caches treat as no connection, if none of them are PostgresBackends
+    """
+    pools = {await item._get_pool() for item in caches if isinstance(item, PostgresBackend)}
+    if not pools:
+        yield None
+        return
+
+    if len(pools) > 1:
+        raise ValueError('Caches are not in the same database')
+
+    async with pools.pop().acquire() as _conn:
+        async with _conn.transaction():
+            yield _conn
+
 class PostgresBackend:
     """
     Simple postgres cache.
@@ -76,6 +234,11 @@ class PostgresBackend:
                  db_name='lm_cache_db',
                  db_table='cache',
                  keep_expired=True,
+                 unlogged=False,
+                 fillfactor=None,
+                 pool_config=None,
+                 hit_boost=0,
+                 max_hit_boost=0,
                  loop=None,
                  **kwargs):
         
@@ -86,6 +249,11 @@ class PostgresBackend:
         self._db_name = db_name
         self._db_table = db_table
         self._keep_expired = keep_expired
+        self._unlogged = unlogged
+        self._fillfactor = fillfactor
+        self._pool_config = pool_config or {}
+        self._hit_boost = int(hit_boost)
+        self._max_hit_boost = int(max_hit_boost)
 
         self._pool = None
         self.__pool_lock = None
@@ -103,24 +271,36 @@ class PostgresBackend:
         async with self._pool_lock:
             if self._pool is None:
                 
-                # Initialize pool
-                self._pool = await asyncpg.create_pool(host = self._db_host,
-                                                       port = self._db_port,
-                                                       user = self._db_user,
-                                                       password = self._db_password,
-                                                       database = self._db_name,
-                                                       loop = self._loop,
-                                                       statement_cache_size=0)
+                # All the caches in a database share a pool
+                pool = await get_shared_pool(self._db_host,
+                                             self._db_port,
+                                             self._db_user,
+                                             self._db_password,
+                                             self._db_name,
+                                             loop = self._loop,
+                                             **self._pool_config)
                 
                 # Make sure table is created
-                async with self._pool.acquire() as _conn:
+                async with pool.acquire() as _conn:
                     await self._create_table(_conn)
+
+                self._pool = pool
                 
             return self._pool
 
+    @property
+    def db_table(self):
+        return self._db_table
+
+    async def warm_up(self):
+        """
+        Opens the pool's connections ahead of the first query
+        """
+        await self._get_pool()
+
     async def _close(self, *args, **kwargs):
-        if self._pool is not None:
-            await self._pool.close()
+        # The pool is shared with other caches, see close_shared_pools
+        self._pool = None
     
     async def _create_table(self, _conn=None):
 
@@ -133,6 +313,9 @@ class PostgresBackend:
 
         if table_exists:
             logger.debug("table exists")
+            await self._update_table_storage(_conn)
+            await self._add_missing_columns(_conn)
+            await self._create_due_index(_conn)
         else:
             logger.debug("table doesn't exist")
             await _conn.execute("""CREATE OR REPLACE FUNCTION cache_updated() RETURNS TRIGGER
@@ -146,13 +329,138 @@ $$
 language 'plpgsql';"""
             )
 
+            # Unlogged tables skip the WAL but are emptied after a crash. Free space left
+            # by a lower fillfactor lets updates stay on the same page
+            unlogged = "UNLOGGED " if self._unlogged else ""
+            storage = f" WITH (fillfactor = {int(self._fillfactor)})" if self._fillfactor else ""
             await _conn.execute(
-                f"CREATE TABLE IF NOT EXISTS {self._db_table} (key varchar PRIMARY KEY, expires timestamp with time zone, updated timestamp with time zone default current_timestamp, value bytea);"
+                f"CREATE {unlogged}TABLE IF NOT EXISTS {self._db_table} (key varchar PRIMARY KEY, expires timestamp with time zone, updated timestamp with time zone default current_timestamp, value bytea, claimed_until timestamp with time zone, hits integer NOT NULL DEFAULT 0){storage};"
                 f"CREATE INDEX IF NOT EXISTS {self._db_table}_expires_idx ON {self._db_table}(expires);"
                 f"CREATE INDEX IF NOT EXISTS {self._db_table}_updated_idx ON {self._db_table}(updated DESC) INCLUDE (key);"
                 f"CREATE TRIGGER {self._db_table}_updated_trigger BEFORE UPDATE ON {self._db_table} FOR EACH ROW WHEN (OLD.value IS DISTINCT FROM NEW.value) EXECUTE PROCEDURE cache_updated();"
             )
+            await self._create_due_index(_conn)
+
+        # Progress of crawler jobs that can be resumed, shared by all the caches in the database
+        await _conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_checkpoint (name varchar PRIMARY KEY, value varchar, "
+            "updated timestamp with time zone default current_timestamp);"
+        )
             
+    # Columns added since tables were first created. Neither rewrites the table
+    ADDED_COLUMNS = {
+        'claimed_until': 'timestamp with time zone',
+        'hits': 'integer NOT NULL DEFAULT 0',
+    }
+
+    async def _add_missing_columns(self, _conn):
+        """
+        Adds any of ADDED_COLUMNS an existing table lacks. Checked first because ALTER TABLE takes
+        an exclusive lock even when there is nothing to do, which would queue every query on the
+        table behind it each time a process starts
+        """
+        existing = {row['column_name'] for row in await _conn.fetch(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = $1;",
+            self._db_table
+        )}
+
+        for column, definition in self.ADDED_COLUMNS.items():
+            if column not in existing:
+                logger.info(f"Adding column {column} to {self._db_table}")
+                await _conn.execute(f"ALTER TABLE {self._db_table} ADD COLUMN IF NOT EXISTS {column} {definition};")
+
+    async def _create_due_index(self, _conn):
+        """
+        Indexes when rows are due if hits bring them forward, so the crawler can read the next
+        due rows in order rather than sorting every row that might be due. Built concurrently
+        so an existing table can still be written to meanwhile
+        """
+        if not self._max_hit_boost:
+            return
+
+        # Subtracting a whole number of seconds doesn't depend on the time zone, so unlike
+        # timestamptz - interval in general this is safe to declare immutable and index
+        if await _conn.fetchval("SELECT to_regprocedure('cache_due(timestamptz, integer, integer, integer)');") is None:
+            await _conn.execute(
+                "CREATE OR REPLACE FUNCTION cache_due(expires timestamptz, hits integer, hit_boost integer, max_hit_boost integer) "
+                "RETURNS timestamptz LANGUAGE sql IMMUTABLE PARALLEL SAFE AS "
+                "$$ SELECT expires - least(hits::bigint * hit_boost, max_hit_boost) * interval '1 second' $$;"
+            )
+
+        # Named after the boosts since the index only matches queries using the same ones
+        index = f"{self._db_table}_due_{self._hit_boost}_{self._max_hit_boost}_idx"
+        valid = await _conn.fetchval("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1);", index)
+        if valid is None:
+            logger.info(f"Creating index {index}")
+            due, _ = self._due_filter()
+            try:
+                await _conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {self._db_table} ({due});")
+            except asyncpg.PostgresError as error:
+                # Most likely another process creating it at the same time
+                logger.warning(f"Could not create index {index}: {error!r}")
+        elif not valid:
+            logger.warning(f"Index {index} is invalid, drop it to have it rebuilt")
+
+    async def _update_table_storage(self, _conn):
+        """
+        Applies the storage options to an existing table where that is cheap to do
+        """
+        if self._fillfactor:
+            # Only affects newly written pages so doesn't rewrite the table
+            await _conn.execute(f"ALTER TABLE {self._db_table} SET (fillfactor = {int(self._fillfactor)});")
+
+        persistence = await _conn.fetchval(
+            "SELECT relpersistence FROM pg_class WHERE oid = to_regclass($1);",
+            self._db_table
+        )
+        if (persistence == 'u') != bool(self._unlogged):
+            # Changing this rewrites the whole table so leave it to an admin
+            logger.warning(f"Table {self._db_table} is {'unlogged' if persistence == 'u' else 'logged'} "
+                           f"but configured otherwise. Run ALTER TABLE {self._db_table} SET "
+                           f"{'UNLOGGED' if self._unlogged else 'LOGGED'}; to change it")
+
+    @conn
+    async def _sweep_expired(self, expired_before, batch_size, _conn=None):
+        deleted = 0
+        while True:
+            result = await _conn.execute(
+                f"DELETE FROM {self._db_table} WHERE key IN ("
+                f"SELECT key FROM {self._db_table} WHERE expires < $1 LIMIT $2 FOR UPDATE SKIP LOCKED"
+                ");",
+                expired_before,
+                batch_size
+            )
+            count = int(result.split()[-1])
+            deleted += count
+
+            if count < batch_size:
+                return deleted
+
+    @conn
+    async def _table_stats(self, _conn=None):
+        result = await _conn.fetchrow(
+            "SELECT pg_total_relation_size(c.oid) AS total_bytes, "
+            "pg_relation_size(c.oid) AS table_bytes, "
+            "pg_indexes_size(c.oid) AS index_bytes, "
+            "s.n_live_tup AS live_rows, "
+            "s.n_dead_tup AS dead_rows, "
+            "s.last_autovacuum, "
+            "c.relpersistence = 'u' AS unlogged, "
+            "c.reloptions "
+            "FROM pg_class c JOIN pg_stat_user_tables s ON s.relid = c.oid "
+            "WHERE c.oid = to_regclass($1);",
+            self._db_table
+        )
+        expired = await _conn.fetchval(
+            f"SELECT count(*) FROM {self._db_table} WHERE expires < current_timestamp;"
+        )
+
+        stats = dict(result.items())
+        rows = stats['live_rows'] + stats['dead_rows']
+        stats['dead_ratio'] = round(stats['dead_rows'] / rows, 3) if rows else 0
+        stats['expired_rows'] = expired
+        return stats
+
     @conn
     async def _get(self, key, encoding="utf-8", _conn=None):
         try:
@@ -173,17 +481,17 @@ language 'plpgsql';"""
 
     @conn
     async def _multi_get(self, keys, encoding="utf-8", _conn=None):
+        if not keys:
+            return []
+
         try:
             start = timer()
+            # One row per requested key in the order requested, with nulls for missing keys
             result = await _conn.fetch(
-                f"""
-select value, expires from {self._db_table}
-right join
-(
-    select key, row_number() over() as key_sorter
-    from (select unnest($1::text[]) as key) as y
-) x on x.key = spotify.key
-order by x.key_sorter""",
+                "SELECT c.value, c.expires "
+                "FROM unnest($1::text[]) WITH ORDINALITY AS k(key, ord) "
+                f"LEFT JOIN {self._db_table} c ON c.key = k.key "
+                "ORDER BY k.ord;",
                 keys
             )
             end = timer()
@@ -221,6 +529,13 @@ order by x.key_sorter""",
             expiry = None
         
         records = [(key, expiry, value) for key, value in pairs]
+        return await self._multi_set_records(records, _conn=_conn)
+
+    async def _copy_records(self, records, on_conflict, _conn):
+        """
+        Inserts (key, expiry, serialized value) records using COPY
+        :return: Number of rows inserted or updated
+        """
         logger.debug(records[1:10])
         
         async with _conn.transaction():
@@ -231,16 +546,47 @@ order by x.key_sorter""",
             result = await _conn.copy_records_to_table("tmp_table", records=records)
             logger.debug(result)
             
-            await _conn.execute(
+            result = await _conn.execute(
                 f"INSERT INTO {self._db_table} (key, expires, value) "
                 "SELECT key, expires, value FROM tmp_table "
-                "ON CONFLICT(key) DO UPDATE "
-                "SET expires = EXCLUDED.expires, "
-                "value = EXCLUDED.value;",
+                f"ON CONFLICT(key) {on_conflict};",
             )
+
+            # Drop now rather than on commit in case this is part of a larger transaction
+            await _conn.execute("DROP TABLE tmp_table;")
             
+        return int(result.split()[-1]) if result else 0
+
+    @conn
+    async def _multi_set_records(self, records, _conn=None):
+        """
+        Upserts (key, expiry, serialized value) records using COPY
+        """
+        await self._copy_records(records, "DO UPDATE SET expires = EXCLUDED.expires, value = EXCLUDED.value", _conn)
         return True
 
+    @conn
+    async def _multi_add_records(self, records, _conn=None):
+        """
+        Inserts (key, expiry, serialized value) records using COPY, leaving existing keys alone
+        """
+        return await self._copy_records(records, "DO NOTHING", _conn)
+
+    @conn
+    async def _get_checkpoint(self, name, _conn=None):
+        return await _conn.fetchval("SELECT value FROM cache_checkpoint WHERE name = $1;", name)
+
+    @conn
+    async def _set_checkpoint(self, name, value, _conn=None):
+        if value is None:
+            await _conn.execute("DELETE FROM cache_checkpoint WHERE name = $1;", name)
+        else:
+            await _conn.execute(
+                "INSERT INTO cache_checkpoint (name, value) VALUES ($1, $2) "
+                "ON CONFLICT(name) DO UPDATE SET value = EXCLUDED.value, updated = current_timestamp;",
+                name, value
+            )
+
     @conn
     async def _delete(self, key, _conn=None):
         await _conn.execute(
@@ -248,7 +594,54 @@ order by x.key_sorter""",
             key
         )
         return True
+
+    @conn
+    async def _multi_delete(self, keys, _conn=None):
+        await _conn.execute(
+            f"DELETE FROM {self._db_table} WHERE key = ANY($1::text[]);",
+            keys
+        )
+        return True
     
+    @conn
+    async def _prune_range(self, after, until, keep, _conn=None):
+        result = await _conn.execute(
+            f"DELETE FROM {self._db_table} "
+            "WHERE ($1::text IS NULL OR key > $1) AND ($2::text IS NULL OR key <= $2) "
+            "AND NOT key = ANY($3::text[]);",
+            after, until, keep
+        )
+        return int(result.split()[-1])
+
+    @conn
+    async def _start_merge(self, _conn=None):
+        await _conn.execute(
+            f"DROP TABLE IF EXISTS {self._db_table}_merged;"
+            f"CREATE UNLOGGED TABLE {self._db_table}_merged (key varchar);"
+        )
+
+    @conn
+    async def _add_merged(self, keys, _conn=None):
+        await _conn.copy_records_to_table(f"{self._db_table}_merged", records=[(key,) for key in keys])
+
+    @conn
+    async def _finish_merge(self, _conn=None):
+        async with _conn.transaction():
+            result = await _conn.execute(
+                f"DELETE FROM {self._db_table} WHERE NOT EXISTS "
+                f"(SELECT 1 FROM {self._db_table}_merged merged WHERE merged.key = {self._db_table}.key);"
+            )
+            await _conn.execute(f"DROP TABLE {self._db_table}_merged;")
+        return int(result.split()[-1])
+
+    @conn
+    async def _multi_expire(self, keys, _conn=None):
+        result = await _conn.execute(
+            f"UPDATE {self._db_table} SET expires = current_timestamp WHERE key = ANY($1::text[]);",
+            keys
+        )
+        return int(result.split()[-1])
+
     @conn
     async def _expire(self, key, ttl, _conn=None):
         if ttl != 0:
@@ -268,17 +661,82 @@ order by x.key_sorter""",
         await _conn.execute(f"TRUNCATE {self._db_table};")
         return True
     
+    def _due_filter(self):
+        """
+        SQL for when a row is due and the condition selecting rows due before $1. Popular rows
+        are due hit_boost seconds per hit before they expire, up to max_hit_boost seconds
+        """
+        if not self._max_hit_boost:
+            return "expires", "expires < $1"
+
+        # Matches the index made by _create_due_index so rows are read in due order
+        due = f"cache_due(expires, hits, {self._hit_boost}, {self._max_hit_boost})"
+        return due, f"{due} < $1"
+
     @conn
     async  def _get_stale(self, count, expires_before, _conn=None):
+        due, condition = self._due_filter()
         results = await _conn.fetch(
             f"SELECT key FROM {self._db_table} "
-            "WHERE expires < $1 "
-            "ORDER by expires "
+            f"WHERE {condition} "
+            f"ORDER by {due} "
             "LIMIT $2;",
             expires_before, count
         )
         return [item['key'] for item in results] if results else []
 
+    @conn
+    async def _get_expiring(self, count, expires_before, _conn=None):
+        due, condition = self._due_filter()
+        results = await _conn.fetch(
+            f"SELECT key, {due} AS due FROM {self._db_table} "
+            f"WHERE {condition} "
+            "ORDER by due "
+            "LIMIT $2;",
+            expires_before, count
+        )
+        return [(item['key'], item['due']) for item in results]
+
+    @conn
+    async def _claim_expiring(self, count, expires_before, lease, _conn=None):
+        due, condition = self._due_filter()
+        results = await _conn.fetch(
+            f"UPDATE {self._db_table} SET claimed_until = current_timestamp + $3 * interval '1 second' "
+            "WHERE key IN ("
+            f"SELECT key FROM {self._db_table} "
+            f"WHERE {condition} AND (claimed_until IS NULL OR claimed_until < current_timestamp) "
+            f"ORDER BY {due} "
+            "LIMIT $2 FOR UPDATE SKIP LOCKED"
+            f") RETURNING key, {due} AS due;",
+            expires_before, count, lease
+        )
+        return sorted(((item['key'], item['due']) for item in results), key=lambda item: item[1])
+
+    @conn
+    async def _get_next_unclaimed(self, expires_before, _conn=None):
+        due, condition = self._due_filter()
+        return await _conn.fetchval(
+            f"SELECT {due} AS due FROM {self._db_table} "
+            f"WHERE {condition} AND (claimed_until IS NULL OR claimed_until < current_timestamp) "
+            "ORDER BY due "
+            "LIMIT 1;",
+            expires_before
+        )
+
+    @conn
+    async def _add_hits(self, keys, hits, _conn=None):
+        await _conn.execute(
+            f"UPDATE {self._db_table} SET hits = {self._db_table}.hits + v.hits "
+            "FROM unnest($1::text[], $2::integer[]) AS v(key, hits) "
+            f"WHERE {self._db_table}.key = v.key;",
+            keys, hits
+        )
+
+    @conn
+    async def _decay_hits(self, _conn=None):
+        result = await _conn.execute(f"UPDATE {self._db_table} SET hits = hits / 2 WHERE hits > 0;")
+        return int(result.split()[-1])
+
     @conn
     async def _get_recently_updated(self, updated_since, limit, _conn=None):
         results = await _conn.fetch(
@@ -318,6 +776,345 @@ class PostgresCache(PostgresBackend, BaseCache):
     async def get_recently_updated(self, updated_since, limit, _conn=None):
         return await self._get_recently_updated(updated_since, limit, _conn=_conn)
 
+    async def get_expiring(self, count, expires_before, _conn=None):
+        """
+        As get_stale but with when each key is due, which is its expiry brought forward for popular keys
+        :return: List of (key, due) ordered by due
+        """
+        return await self._get_expiring(count, expires_before, _conn=_conn)
+
+    async def claim_expiring(self, count, expires_before, lease, _conn=None):
+        """
+        As get_expiring but skips keys claimed by someone else and claims the returned keys for
+        lease seconds, so several crawlers can share the cache without refreshing the same keys
+        :return: List of (key, due) ordered by due
+        """
+        return await self._claim_expiring(count, expires_before, lease, _conn=_conn)
+
+    async def get_next_unclaimed(self, expires_before, _conn=None):
+        """
+        When the next key nobody has claimed is due, if before expires_before
+        :return: datetime or None
+        """
+        return await self._get_next_unclaimed(expires_before, _conn=_conn)
+
+    async def add_hits(self, counts, _conn=None):
+        """
+        Adds to the hit counts used to refresh popular keys first
+        :param counts: Dict of key to number of hits
+        """
+        if not counts:
+            return True
+
+        # Sorted so concurrent flushes lock rows in the same order
+        items = sorted((self.build_key(key), hits) for key, hits in counts.items())
+        await self._add_hits([key for key, _ in items], [hits for _, hits in items], _conn=_conn)
+        return True
+
+    async def decay_hits(self, _conn=None):
+        """
+        Halves the hit counts so popularity follows recent traffic
+        :return: Number of rows updated
+        """
+        return await self._decay_hits(_conn=_conn)
+
+    async def multi_set_expiring(self, items, _conn=None):
+        """
+        Stores several values in one statement, each with its own expiry
+        :param items: List of (key, value, expiry datetime) tuples
+        """
+        if not items:
+            return True
+
+        records = [(self.build_key(key), expiry, self.serializer.dumps(value)) for key, value, expiry in items]
+        return await self._multi_set_records(records, _conn=_conn)
+
+    async def multi_add_expiring(self, keys, expiry, _conn=None):
+        """
+        Adds keys with no value that aren't in the cache yet, leaving existing ones alone
+        :return: Number of keys added
+        """
+        if not keys:
+            return 0
+
+        value = self.serializer.dumps(None)
+        return await self._multi_add_records([(self.build_key(key), expiry, value) for key in keys], _conn=_conn)
+
+    async def multi_expire(self, keys, add_missing=True, _conn=None):
+        """
+        Expires several keys now, keeping their values so they can still be served stale
+        while they are refreshed
+        :param add_missing: Add keys that aren't cached yet with no value, so the crawler picks them up
+        :return: Number of existing keys expired
+        """
+        if not keys:
+            return 0
+
+        expired = await self._multi_expire([self.build_key(key) for key in keys], _conn=_conn)
+        if add_missing:
+            await self.multi_add_expiring(keys, datetime.datetime.now(datetime.timezone.utc), _conn=_conn)
+        return expired
+
+    async def prune_range(self, after, until, keep, _conn=None):
+        """
+        Deletes the keys after after, up to and including until, that aren't in keep. Keys are
+        compared as text, which orders lowercase uuids the same way as postgres uuids
+        :param after: Exclusive lower bound or None for no bound
+        :param until: Inclusive upper bound or None for no bound
+        :return: Number of keys deleted
+        """
+        return await self._prune_range(after and self.build_key(after), until and self.build_key(until),
+                                       [self.build_key(key) for key in keep], _conn=_conn)
+
+    async def start_merge(self):
+        """
+        Starts replacing the whole cache with the pairs passed to merge. Existing keys keep being
+        served until finish_merge deletes the ones that weren't merged
+        """
+        await self._start_merge()
+
+    async def merge(self, pairs, ttl=None):
+        """
+        Sets several pairs and records their keys as merged
+        """
+        async with transaction(self) as _conn:
+            await self.multi_set(pairs, ttl=ttl, timeout=None, _conn=_conn)
+            await self._add_merged([self.build_key(key) for key, _ in pairs], _conn=_conn)
+
+    async def finish_merge(self):
+        """
+        Deletes every key that wasn't merged since start_merge
+        :return: Number of keys deleted
+        """
+        return await self._finish_merge()
+
+    async def get_checkpoint(self, name, _conn=None):
+        """
+        Gets the value saved by set_checkpoint, or None
+        """
+        return await self._get_checkpoint(name, _conn=_conn)
+
+    async def set_checkpoint(self, name, value, _conn=None):
+        """
+        Saves the progress of a resumable job. None removes the checkpoint
+        """
+        return await self._set_checkpoint(name, value, _conn=_conn)
+
+    async def multi_delete(self, keys, _conn=None):
+        """
+        Deletes several keys in one statement
+        """
+        if not keys:
+            return True
+
+        return await self._multi_delete([self.build_key(key) for key in keys], _conn=_conn)
+
+    async def sweep_expired(self, grace, batch_size=10000, _conn=None):
+        """
+        Deletes rows that expired more than grace seconds ago, in batches so locks are
+        held briefly. Does nothing if the cache keeps expired rows
+        :return: Number of rows deleted
+        """
+        if self._keep_expired:
+            return 0
+
+        expired_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=grace)
+        return await self._sweep_expired(expired_before, batch_size, _conn=_conn)
+
+    async def table_stats(self, _conn=None):
+        """
+        Size and bloat of the cache table
+        """
+        return await self._table_stats(_conn=_conn)
+
+
+class MemoryCache(object):
+    """
+    Bounded in-process LRU cache of already deserialized values and their expiry.
+
+    Sits in front of a PostgresCache so the hottest keys don't need a database round trip
+    and unpickle. Each worker has its own copy, so entries are only kept for at most
+    max_ttl seconds to bound how long an invalidation made on another worker goes unseen.
+    """
+
+    def __init__(self, max_size=10000, max_ttl=60):
+        """
+        :param max_size: Maximum number of entries to hold. 0 disables the cache
+        :param max_ttl: Maximum number of seconds to serve an entry from memory
+        """
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+
+        self._items = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """
+        Gets a value from the cache
+        :param key: Key to get
+        :return: (value, expiry) tuple or (None, None) if missing or expired. The value is a
+                 shallow copy so callers may modify top level items without corrupting the cache
+        """
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None, None
+
+        value, expiry, local_expiry = item
+        if local_expiry <= datetime.datetime.now(datetime.timezone.utc):
+            del self._items[key]
+            self.misses += 1
+            return None, None
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return copy.copy(value), expiry
+
+    def set(self, key, value, expiry):
+        """
+        Stores a value in the cache
+        :param key: Key to set
+        :param value: Value to store. A shallow copy is stored
+        :param expiry: Time the value expires
+        """
+        if self.max_size <= 0 or value is None:
+            return
+
+        local_expiry = min(expiry, datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.max_ttl))
+
+        self._items[key] = (copy.copy(value), expiry, local_expiry)
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'Size': len(self._items),
+                'MaxSize': self.max_size,
+                'Hits': self.hits,
+                'Misses': self.misses,
+                'Evictions': self.evictions,
+                'HitRatio': self.hits / requests if requests else 0}
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key so that only one runs at a time in this
+    process and any others await its result
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, key):
+        return key in self._tasks
+
+    async def run(self, key, function, *args, **kwargs):
+        """
+        Runs function unless a call for key is already in flight, in which case waits for that
+        :param key: Key to deduplicate on
+        :param function: Coroutine function to call
+        :return: Result of function. Exceptions are raised to every caller
+        """
+        # Shield so one cancelled caller doesn't cancel the work for everyone else
+        return await asyncio.shield(self.start(key, function, *args, **kwargs))
+
+    def start(self, key, function, *args, **kwargs):
+        """
+        Starts function for key without waiting, unless a call for key is already in flight
+        :return: Task for the call in flight
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        return task
+
+    async def run_many(self, keys, function, *args, **kwargs):
+        """
+        As run for several keys at once. The keys not already in flight are passed to a single
+        call of function, which returns a dict of key to result, and the rest are waited for
+        :param keys: List of keys
+        :param function: Coroutine function taking a list of keys
+        :return: Dict of key to result, None for any keys function didn't return. Exceptions
+                 are returned in place of results since each key may have its own
+        """
+        new = [key for key in dict.fromkeys(keys) if key not in self._tasks]
+        if new:
+            batch = asyncio.ensure_future(function(new, *args, **kwargs))
+            for key in new:
+                task = asyncio.ensure_future(self._pick(batch, key))
+                self._tasks[key] = task
+                task.add_done_callback(functools.partial(self._done, key))
+
+        tasks = {key: self._tasks[key] for key in keys}
+        results = await asyncio.gather(*(asyncio.shield(task) for task in tasks.values()),
+                                       return_exceptions=True)
+        return dict(zip(tasks.keys(), results))
+
+    @staticmethod
+    async def _pick(batch, key):
+        return (await asyncio.shield(batch)).get(key)
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+        # Retrieve any exception in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+class HitCounter(object):
+    """
+    Counts a sample of reads of a cache's keys in memory so they can be added to the
+    table in one statement by flush
+    """
+
+    def __init__(self, cache, sample_rate=0.1):
+        self.cache = cache
+        self.sample_rate = sample_rate
+        # Each sampled hit stands for the ones that weren't
+        self._weight = max(int(round(1 / sample_rate)), 1) if sample_rate else 0
+        self._counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def record(self, key):
+        if self.sample_rate and random.random() < self.sample_rate:
+            self._counts[key] += self._weight
+
+    async def flush(self):
+        """
+        :return: Number of keys flushed
+        """
+        counts, self._counts = self._counts, collections.Counter()
+        try:
+            await self.cache.add_hits(counts)
+        except Exception:
+            # Keep the counts for the next flush along with any recorded in the meantime
+            self._counts.update(counts)
+            raise
+        return len(counts)
 
 class NullCache(BaseCache):
     """
@@ -335,6 +1132,69 @@ class NullCache(BaseCache):
     
     async def _set(self, key, value, ttl=None, _cas_token=None, _conn=None):
         return True
-    
+
+    async def _add(self, key, value, ttl=None, _conn=None):
+        return True
+
+    async def _exists(self, key, _conn=None):
+        return False
+
+    async def _multi_get(self, keys, encoding="utf-8", _conn=None):
+        return [None] * len(keys)
+
+    async def _multi_set(self, pairs, ttl=None, _conn=None):
+        return True
+
+    async def _delete(self, key, _conn=None):
+        return True
+
+    async def _expire(self, key, ttl, _conn=None):
+        return True
+
+    async def multi_set_expiring(self, items, _conn=None):
+        return True
+
+    async def multi_delete(self, keys, _conn=None):
+        return True
+
     async def get_stale(self, count, expires_before, _conn=None):
         return []
+
+    async def get_expiring(self, count, expires_before, _conn=None):
+        return []
+
+    async def claim_expiring(self, count, expires_before, lease, _conn=None):
+        return []
+
+    async def get_next_unclaimed(self, expires_before, _conn=None):
+        return None
+
+    async def add_hits(self, counts, _conn=None):
+        return True
+
+    async def decay_hits(self, _conn=None):
+        return 0
+
+    async def multi_add_expiring(self, keys, expiry, _conn=None):
+        return 0
+
+    async def multi_expire(self, keys, add_missing=True, _conn=None):
+        return 0
+
+    async def prune_range(self, after, until, keep, _conn=None):
+        return 0
+
+    async def start_merge(self):
+        return True
+
+    async def merge(self, pairs, ttl=None):
+        return True
+
+    async def finish_merge(self):
+        return 0
+
+    async def get_checkpoint(self, name, _conn=None):
+        return None
+
+    async def set_checkpoint(self, name, value, _conn=None):
+        return True
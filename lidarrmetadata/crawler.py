@@ -1,8 +1,14 @@
 import argparse
 import asyncio
+import collections
 import datetime
 from datetime import timedelta
+import heapq
 import logging
+import multiprocessing
+import os
+import queue
+import signal
 from timeit import default_timer as timer
 import sys
 
@@ -13,8 +19,12 @@ import lidarrmetadata
 from lidarrmetadata.config import get_config
 from lidarrmetadata import provider
 from lidarrmetadata import util
+from lidarrmetadata import invalidation
 from lidarrmetadata import limit
+from lidarrmetadata import stats
+from lidarrmetadata.cache import transaction, close_shared_pools
 from lidarrmetadata.api import get_artist_info_multi, ArtistNotFoundException, get_release_group_info_multi, ReleaseGroupNotFoundException
+from lidarrmetadata.api import set_artist_responses, set_release_group_responses
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -35,7 +45,222 @@ if CONFIG.SENTRY_DSN:
                     before_send=processor.create_event,
                     send_default_pii=True)
 
-async def update_wikipedia(count = 50, max_ttl = 60 * 60):
+# Lower than any MusicBrainz id, to start paging through ids from
+MIN_MBID = '00000000-0000-0000-0000-000000000000'
+
+# Set in --workers processes to send pipeline stats to the parent
+progress_queue = None
+
+class RefreshScheduler(object):
+    """
+    Dispatches cache keys for refreshing as they come due.
+
+    Upcoming expiries are read from the expires index in bulk and kept in a heap, so the
+    crawler sleeps until the next key is due rather than polling get_stale. Keys are due
+    lead_time seconds before they expire. The window is re-read once the heap runs past
+    what was read, and at least every refill_interval seconds to pick up invalidations.
+    """
+
+    def __init__(self, cache, lead_time = 60 * 60, window = 60 * 60, refill_count = 5000, refill_interval = 60):
+        self.cache = cache
+        self.lead_time = lead_time
+        self.window = window
+        self.refill_count = refill_count
+        self.refill_interval = refill_interval
+
+        self._heap = []
+        self._in_flight = set()
+        # Every key expiring before this is in the heap
+        self._horizon = None
+        self._refilled = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def _due(self, now):
+        return now + timedelta(seconds = self.lead_time)
+
+    async def refill(self):
+        now = provider.utcnow()
+        until = self._due(now) + timedelta(seconds = self.window)
+        items = await self.cache.get_expiring(self.refill_count, until)
+
+        self._heap = [(expires, key) for key, expires in items if key not in self._in_flight]
+        heapq.heapify(self._heap)
+
+        # If the limit was hit we only know about everything up to the last expiry read
+        self._horizon = items[-1][1] if len(items) == self.refill_count else until
+        self._refilled = now
+
+    def _needs_refill(self, now):
+        if self._refilled is None or (now - self._refilled).total_seconds() >= self.refill_interval:
+            return True
+
+        # Once the heap is used up, keys past the horizon may be due too
+        return not self._heap and self._horizon <= self._due(now)
+
+    def _pop_due(self, count, now):
+        keys = []
+        due = self._due(now)
+        while self._heap and len(keys) < count and self._heap[0][0] <= due:
+            _, key = heapq.heappop(self._heap)
+            if key not in self._in_flight:
+                self._in_flight.add(key)
+                keys.append(key)
+        return keys
+
+    async def next_batch(self, count):
+        """
+        Waits until at least one key is due
+        :return: Up to count keys which are marked in flight until passed to done
+        """
+        while True:
+            now = provider.utcnow()
+            if self._needs_refill(now):
+                await self.refill()
+
+            keys = self._pop_due(count, now)
+            if keys:
+                return keys
+
+            # Sleep until the next key is due, or it's time to look for new ones
+            wake = self._refilled + timedelta(seconds = self.refill_interval)
+            if self._heap:
+                wake = min(wake, self._heap[0][0] - timedelta(seconds = self.lead_time))
+            await asyncio.sleep(max((wake - provider.utcnow()).total_seconds(), 0.1))
+
+    def done(self, keys):
+        self._in_flight.difference_update(keys)
+
+class LeasedRefreshScheduler(RefreshScheduler):
+    """
+    RefreshScheduler for several crawlers sharing the same cache.
+
+    Due keys are claimed in the database for lease seconds, skipping keys other crawlers
+    have claimed. Claims aren't released: refreshed keys are no longer due, and keys that
+    failed or whose crawler died are picked up again once the lease runs out.
+
+    When nothing can be claimed the crawler sleeps until the next unclaimed key is due. It
+    wakes at least once a lease since claimed keys come back when their lease runs out.
+    """
+
+    def __init__(self, cache, lead_time = 60 * 60, lease = 60 * 10):
+        super().__init__(cache, lead_time = lead_time)
+        self.lease = lease
+
+    async def next_batch(self, count):
+        while True:
+            now = provider.utcnow()
+            items = await self.cache.claim_expiring(count, self._due(now), self.lease)
+            keys = [key for key, _ in items if key not in self._in_flight]
+            if keys:
+                self._in_flight.update(keys)
+                return keys
+
+            wake = now + timedelta(seconds = self.lease)
+            due = await self.cache.get_next_unclaimed(self._due(wake))
+            if due is not None:
+                wake = min(wake, due - timedelta(seconds = self.lead_time))
+            await asyncio.sleep(max((wake - provider.utcnow()).total_seconds(), 0.1))
+
+def get_scheduler(cache, lead_time):
+    if CONFIG.CRAWLER_LEASES:
+        return LeasedRefreshScheduler(cache, lead_time = lead_time, lease = CONFIG.CRAWLER_LEASE_TTL)
+    return RefreshScheduler(cache, lead_time = lead_time)
+
+class RefreshPipeline(object):
+    """
+    Refreshes keys from a RefreshScheduler with a fixed number of workers.
+
+    A producer keeps a bounded queue topped up with due keys so the next batch is read while
+    the current one is refreshing. Each worker takes up to chunk_size queued keys at a time,
+    so a slow key only holds up its own worker rather than the whole batch.
+    """
+
+    def __init__(self, name, scheduler, refresh, concurrency = 10, chunk_size = 1, prefetch = 100, stats_interval = 60):
+        self.name = name
+        self.scheduler = scheduler
+        self.refresh = refresh
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.stats_interval = stats_interval
+
+        self.queue = asyncio.Queue(maxsize = prefetch)
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+
+        self._stats = stats.TelegrafStatsClient(CONFIG.STATS_HOST,
+                                                CONFIG.STATS_PORT) if CONFIG.ENABLE_STATS else None
+
+    async def produce(self):
+        while True:
+            keys = await self.scheduler.next_batch(self.prefetch)
+            logger.debug(f"Got {len(keys)} stale {self.name} items to refresh")
+            for key in keys:
+                await self.queue.put(key)
+
+    async def _next_chunk(self):
+        keys = [await self.queue.get()]
+        while len(keys) < self.chunk_size and not self.queue.empty():
+            keys.append(self.queue.get_nowait())
+        return keys
+
+    async def work(self):
+        while True:
+            keys = await self._next_chunk()
+
+            self.busy += 1
+            try:
+                await self.refresh(keys)
+            except Exception:
+                self.failed += len(keys)
+                logger.exception(f"Error refreshing {len(keys)} {self.name} items")
+            finally:
+                self.busy -= 1
+                self.processed += len(keys)
+                self.scheduler.done(keys)
+                for _ in keys:
+                    self.queue.task_done()
+
+    def stats(self):
+        return {'processed': self.processed,
+                'failed': self.failed,
+                'queue_depth': self.queue.qsize(),
+                'busy_workers': self.busy,
+                'in_flight': self.scheduler.in_flight,
+                'scheduled': len(self.scheduler)}
+
+    async def report(self):
+        last = self.processed
+        start = timer()
+        while True:
+            await asyncio.sleep(self.stats_interval)
+
+            elapsed = timer() - start
+            values = self.stats()
+            values['throughput'] = (values['processed'] - last) / elapsed
+            last = values['processed']
+            start += elapsed
+
+            logger.info(f"{self.name}: {values['throughput']:.1f} items/s, queue {values['queue_depth']}, "
+                        f"{values['busy_workers']}/{self.concurrency} workers busy, {values['failed']} failed")
+            if self._stats:
+                self._stats.metric('crawler', values, tags={'source': self.name})
+            if progress_queue is not None:
+                progress_queue.put((os.getpid(), self.name, values))
+
+    async def run(self):
+        await asyncio.gather(self.produce(),
+                             self.report(),
+                             *(self.work() for _ in range(self.concurrency)))
+
+async def update_wikipedia(count = 50, max_ttl = 60 * 60, concurrency = 5):
     
     # Use an aiohttp session which only allows a single concurrent connection per host to be nice
     # https://www.mediawiki.org/wiki/API:Etiquette
@@ -44,20 +269,14 @@ async def update_wikipedia(count = 50, max_ttl = 60 * 60):
     async with aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(sock_read = 2), connector = aiohttp.TCPConnector(limit_per_host=1)) as session:
         wikipedia_provider = provider.WikipediaProvider(session, limit.NullRateLimiter())
 
-        while True:
-            keys = await util.WIKI_CACHE.get_stale(count, provider.utcnow() + timedelta(seconds = max_ttl))
-            logger.debug(f"Got {len(keys)} stale wikipedia items to refresh")
-
-            start = timer()
+        async def refresh(keys):
             await asyncio.gather(*(wikipedia_provider.get_artist_overview(url, ignore_cache=True) for url in keys))
-            logger.debug(f"Refreshed {len(keys)} wikipedia overviews in {timer() - start:.1f}s")
 
-            # If there weren't any to update sleep, otherwise continue
-            if not keys:
-                await asyncio.sleep(60)
+        scheduler = get_scheduler(util.WIKI_CACHE, lead_time = max_ttl)
+        await RefreshPipeline('wikipedia', scheduler, refresh, concurrency = concurrency, prefetch = count).run()
 
             
-async def update_fanart(count = 500, max_ttl = 60 * 60):
+async def update_fanart(count = 500, max_ttl = 60 * 60, concurrency = 10, chunk_size = 50):
     # Use an aiohttp session which only allows 10 concurrent connections per host to be (a little bit) nice
     # Only put timeout on sock_read - otherwise we can get timed out waiting for a connection from the pool.
     # Don't make these count towards rate limiting.
@@ -71,19 +290,11 @@ async def update_fanart(count = 500, max_ttl = 60 * 60):
             limiter=limit.NullRateLimiter()
         )
 
-        while True:
-            keys = await util.FANART_CACHE.get_stale(count, provider.utcnow() + timedelta(seconds = max_ttl))
-            logger.debug(f"Got {len(keys)} stale fanart items to refresh")
-
-            start = timer()
-            await asyncio.gather(*(fanart_provider.refresh_images(mbid) for mbid in keys))
-            logger.debug(f"Refreshed {len(keys)} fanart keys in {timer() - start:.1f}s")
+        scheduler = get_scheduler(util.FANART_CACHE, lead_time = max_ttl)
+        await RefreshPipeline('fanart', scheduler, fanart_provider.refresh_images_batch,
+                              concurrency = concurrency, chunk_size = chunk_size, prefetch = count).run()
 
-            # If there weren't any to update sleep, otherwise continue
-            if not keys:
-                await asyncio.sleep(60)
-
-async def update_tadb(count = 500, max_ttl = 60 * 60):
+async def update_tadb(count = 500, max_ttl = 60 * 60, concurrency = 5):
     # Use an aiohttp session which only allows 10 concurrent connections per host to be (a little bit) nice
     # Only put timeout on sock_read - otherwise we can get timed out waiting for a connection from the pool.
     # Don't make these count towards rate limiting.
@@ -98,93 +309,260 @@ async def update_tadb(count = 500, max_ttl = 60 * 60):
             limiter=limit.NullRateLimiter()
         )
 
-        while True:
-            keys = await util.TADB_CACHE.get_stale(count, provider.utcnow() + timedelta(seconds = max_ttl))
-            logger.debug(f"Got {len(keys)} stale tadb items to refresh")
-
-            start = timer()
+        async def refresh(keys):
             await asyncio.gather(*(tadb_provider.refresh_data(mbid) for mbid in keys))
-            logger.debug(f"Refreshed {len(keys)} tadb keys in {timer() - start:.1f}s")
 
-            # If there weren't any to update sleep, otherwise continue
-            if not keys:
-                await asyncio.sleep(60)
+        scheduler = get_scheduler(util.TADB_CACHE, lead_time = max_ttl)
+        await RefreshPipeline('tadb', scheduler, refresh, concurrency = concurrency, prefetch = count).run()
             
+async def initialize_keys(cache, get_ids, name, chunk_size = 50000):
+    """
+    Merges every id from get_ids into the cache one page at a time, so existing entries keep
+    being served. New ids are due straight away, and cached ids in the range a page covers
+    that get_ids no longer returns are deleted. The last id merged is checkpointed so an
+    interrupted run carries on from there
+    :param get_ids: Function taking (after, limit) and returning ids in order
+    """
+    checkpoint = f"initialize_{name}"
+    after = await cache.get_checkpoint(checkpoint)
+    if after:
+        logger.info(f"Resuming {name} initialization after {after}")
+
+    total = 0
+    added = 0
+    removed = 0
+    while True:
+        start = timer()
+        ids = await get_ids(after or MIN_MBID, chunk_size)
+
+        async with transaction(cache) as _conn:
+            # The last page covers everything after the previous one
+            removed += await cache.prune_range(after, ids[-1] if ids else None, ids, _conn=_conn)
+            if ids:
+                added += await cache.multi_add_expiring(ids, provider.utcnow(), _conn=_conn)
+                await cache.set_checkpoint(checkpoint, ids[-1], _conn=_conn)
+
+        if not ids:
+            break
+
+        after = ids[-1]
+        total += len(ids)
+        logger.info(f"Initialized {total} {name} keys ({added} new, {removed} removed) up to {after} "
+                    f"in {timer() - start:.1f}s")
+
+    logger.info(f"Initialized {total} {name} keys ({added} new, {removed} removed)")
+
+    # Finished so start from the beginning next time
+    await cache.set_checkpoint(checkpoint, None)
+
 async def initialize_artists():
     id_provider = provider.get_providers_implementing(provider.ArtistIdListMixin)[0]
-    
-    ids = await id_provider.get_all_artist_ids()
-    
-    pairs = [(id, None) for id in ids]
-    
-    await util.ARTIST_CACHE.clear()
-    await util.ARTIST_CACHE.multi_set(pairs, ttl=0, timeout=None)
+    await initialize_keys(util.ARTIST_CACHE, id_provider.get_artist_ids_after, "artist",
+                          chunk_size = CONFIG.CRAWLER_INITIALIZE_CHUNK_SIZE)
 
 async def initialize_tadb():
     id_provider = provider.get_providers_implementing(provider.ArtistIdListMixin)[0]
-    
-    ids = await id_provider.get_all_artist_ids()
-    
-    pairs = [(id, None) for id in ids]
-    
-    await util.TADB_CACHE.clear()
-    await util.TADB_CACHE.multi_set(pairs, ttl=0, timeout=None)
+    await initialize_keys(util.TADB_CACHE, id_provider.get_artist_ids_after, "tadb",
+                          chunk_size = CONFIG.CRAWLER_INITIALIZE_CHUNK_SIZE)
     
 async def initialize_albums():
     id_provider = provider.get_providers_implementing(provider.ReleaseGroupIdListMixin)[0]
-    
-    ids = await id_provider.get_all_release_group_ids()
-    
-    pairs = [(id, None) for id in ids]
-    
-    await util.ALBUM_CACHE.clear()
-    await util.ALBUM_CACHE.multi_set(pairs, ttl=0, timeout=None)
+    await initialize_keys(util.ALBUM_CACHE, id_provider.get_release_group_ids_after, "album",
+                          chunk_size = CONFIG.CRAWLER_INITIALIZE_CHUNK_SIZE)
 
 async def initialize_spotify():
     link_provider = provider.get_providers_implementing(provider.ReleaseGroupByIdMixin)[0]
 
-    maps = await link_provider.get_all_spotify_mappings()
+    # Merge the maps in chunks so existing ones keep being served and they never all have to
+    # be in memory, then remove the ones that have gone
+    await util.SPOTIFY_CACHE.start_merge()
 
-    pairs = [(item['spotifyid'], item['mbid']) for item in maps]
+    pairs = []
+    total = 0
+    async for item in link_provider.get_all_spotify_mappings():
+        pairs.append((item['spotifyid'], item['mbid']))
+        if len(pairs) >= CONFIG.CRAWLER_INITIALIZE_CHUNK_SIZE:
+            await util.SPOTIFY_CACHE.merge(pairs)
+            total += len(pairs)
+            pairs = []
+            logger.info(f"Initialized {total} spotify maps")
 
-    await util.SPOTIFY_CACHE.clear()
-    await util.SPOTIFY_CACHE.multi_set(pairs, ttl=None, timeout=None)
+    if pairs:
+        await util.SPOTIFY_CACHE.merge(pairs)
+        total += len(pairs)
 
-async def update_items(multi_function, cache, name, count = 100, max_ttl = 60 * 60):
-    while True:
-        keys = await cache.get_stale(count, provider.utcnow() + timedelta(seconds = max_ttl))
-        logger.debug(f"Got {len(keys)} stale {name}s to refresh")
+    removed = await util.SPOTIFY_CACHE.finish_merge()
+    logger.info(f"Initialized {total} spotify maps ({removed} removed)")
+
+async def refresh_items(multi_function, cache, name, keys, response_function = None):
+    start = timer()
+    results = await multi_function(keys)
+    
+    if not results:
+        missing = keys
+    else:
+        missing = set(keys) - set(item['id'] for item, _ in results)
+        
+    if missing:
+        logger.debug(f"Removing deleted {name}s:\n{missing}")
+
+    # Write the whole batch in one transaction
+    async with transaction(cache) as _conn:
+        await cache.multi_delete(list(missing), _conn=_conn)
+        await cache.multi_set_expiring([(result['id'], result, expiry) for result, expiry in results or []], _conn=_conn)
+
+    # Store the rendered API responses too so requests don't need to build them
+    if results and response_function:
+        await response_function(results)
         
-        if keys:
+    logger.debug(f"Refreshed {len(keys)} {name}s in {timer() - start:.1f}s")
+
+async def update_items(multi_function, cache, name, count = 100, max_ttl = 60 * 60, response_function = None,
+                       concurrency = 2, chunk_size = 100):
+    async def refresh(keys):
+        await refresh_items(multi_function, cache, name, keys, response_function)
+
+    scheduler = get_scheduler(cache, lead_time = max_ttl)
+    await RefreshPipeline(name, scheduler, refresh, concurrency = concurrency, chunk_size = chunk_size, prefetch = count).run()
+    
+async def sweep_caches(interval = 60 * 10, grace = 60 * 60, batch_size = 10000, decay_interval = 60 * 60 * 24):
+    last_decay = timer()
+    while True:
+        for item in util.POSTGRES_CACHES:
             start = timer()
-            results = await multi_function(keys)
-            
-            if not results:
-                missing = keys
-            else:
-                missing = set(keys) - set(item['id'] for item, _ in results)
-                
-            if missing:
-                logger.debug(f"Removing deleted {name}s:\n{missing}")
-                await asyncio.gather(*(cache.delete(id) for id in missing))
-                
-            await asyncio.gather(*(cache.set(result['id'], result, ttl=(expiry - provider.utcnow()).total_seconds()) for result, expiry in results))
-                
-            logger.debug(f"Refreshed {len(keys)} {name}s in {timer() - start:.1f}s")
-
-        else:
-            # If there weren't any to update sleep, otherwise continue
-            await asyncio.sleep(60)
+            deleted = await item.sweep_expired(grace, batch_size)
+            if deleted:
+                logger.debug(f"Deleted {deleted} expired rows from {item.db_table} in {timer() - start:.1f}s")
+
+        # Halve hit counts now and then so popularity follows recent requests
+        if decay_interval and timer() - last_decay >= decay_interval:
+            for item in [item for item in util.POSTGRES_CACHES if item in (util.ARTIST_CACHE, util.ALBUM_CACHE)]:
+                updated = await item.decay_hits()
+                logger.debug(f"Decayed hit counts of {updated} {item.db_table} rows")
+            last_decay = timer()
+
+        await asyncio.sleep(interval)
     
-async def crawl():
-    await asyncio.gather(
-        # Look further ahead for wiki and fanart so external data is ready before we refresh artist/album
-        update_wikipedia(count = CONFIG.CRAWLER_BATCH_SIZE['wikipedia'], max_ttl = 60 * 60 * 2),
-        update_fanart(count = CONFIG.CRAWLER_BATCH_SIZE['fanart'], max_ttl = 60 * 60 * 2),
-        update_tadb(count = CONFIG.CRAWLER_BATCH_SIZE['tadb'], max_ttl = 60 * 60 * 2),
-        update_items(get_artist_info_multi, util.ARTIST_CACHE, "artist", count = CONFIG.CRAWLER_BATCH_SIZE['artist']),
-        update_items(get_release_group_info_multi, util.ALBUM_CACHE, "album", count = CONFIG.CRAWLER_BATCH_SIZE['album'])
-    )
+async def crawl(external = True, sweep = True):
+    tasks = []
+
+    if sweep:
+        tasks.append(sweep_caches(interval = CONFIG.CACHE_SWEEP_INTERVAL, grace = CONFIG.CACHE_SWEEP_GRACE,
+                                  batch_size = CONFIG.CACHE_SWEEP_BATCH_SIZE, decay_interval = CONFIG.CACHE_HIT_DECAY_INTERVAL))
+
+    if external:
+        tasks.extend([
+            # Look further ahead for wiki and fanart so external data is ready before we refresh artist/album
+            update_wikipedia(count = CONFIG.CRAWLER_BATCH_SIZE['wikipedia'], max_ttl = 60 * 60 * 2,
+                             concurrency = CONFIG.CRAWLER_CONCURRENCY['wikipedia']),
+            update_fanart(count = CONFIG.CRAWLER_BATCH_SIZE['fanart'], max_ttl = 60 * 60 * 2,
+                          concurrency = CONFIG.CRAWLER_CONCURRENCY['fanart'], chunk_size = CONFIG.CRAWLER_CHUNK_SIZE['fanart']),
+            update_tadb(count = CONFIG.CRAWLER_BATCH_SIZE['tadb'], max_ttl = 60 * 60 * 2,
+                        concurrency = CONFIG.TADB_CONNECTIONS)
+        ])
+
+        # Expire artists and albums as MusicBrainz changes
+        if CONFIG.MB_CHANGES_AMQP_URL:
+            tasks.append(invalidation.consume_changes())
+
+    tasks.extend([
+        update_items(get_artist_info_multi, util.ARTIST_CACHE, "artist", count = CONFIG.CRAWLER_BATCH_SIZE['artist'],
+                     response_function = set_artist_responses,
+                     concurrency = CONFIG.CRAWLER_CONCURRENCY['artist'], chunk_size = CONFIG.CRAWLER_CHUNK_SIZE['artist']),
+        update_items(get_release_group_info_multi, util.ALBUM_CACHE, "album", count = CONFIG.CRAWLER_BATCH_SIZE['album'],
+                     response_function = set_release_group_responses,
+                     concurrency = CONFIG.CRAWLER_CONCURRENCY['album'], chunk_size = CONFIG.CRAWLER_CHUNK_SIZE['album'])
+    ])
+
+    await asyncio.gather(*tasks)
+
+async def run_until_terminated(coro):
+    task = asyncio.ensure_future(coro)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info(f"Crawler worker {os.getpid()} stopped")
+    finally:
+        await close_shared_pools()
+
+def crawl_worker(index, progress):
+    global progress_queue
+    progress_queue = progress
+
+    # Ctrl-C reaches the whole process group, leave it to the parent to stop us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Workers split the artist and album keys between them by leasing them. Only the first
+    # refreshes external sources and sweeps so external APIs see the same load as one crawler
+    CONFIG.CRAWLER_LEASES = True
+    asyncio.run(run_until_terminated(crawl(external = index == 0, sweep = index == 0)))
+
+def summarize_progress(latest):
+    """
+    Adds up the latest stats from each worker
+    :param latest: Dict of (pid, source) to pipeline stats
+    :return: Dict of source to summed stats
+    """
+    totals = collections.defaultdict(collections.Counter)
+    for (_, name), values in latest.items():
+        totals[name].update(values)
+    return totals
+
+def run_workers(count, report_interval = 60, stop_timeout = 30):
+    """
+    Runs the crawler in count processes until one of them dies or we are told to stop
+    :return: Exit code
+    """
+    context = multiprocessing.get_context('spawn')
+    progress = context.Queue()
+    workers = [context.Process(target = crawl_worker, args = (index, progress), name = f"crawler-{index}")
+               for index in range(count)]
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {count} crawler workers")
+
+    latest = {}
+    last_report = timer()
+    try:
+        while not stopping and all(worker.is_alive() for worker in workers):
+            try:
+                pid, name, values = progress.get(timeout = 1)
+                latest[(pid, name)] = values
+            except queue.Empty:
+                pass
+
+            if timer() - last_report >= report_interval:
+                for name, values in sorted(summarize_progress(latest).items()):
+                    logger.info(f"all workers {name}: {values['throughput']:.1f} items/s, queue {values['queue_depth']}, "
+                                f"{values['processed']} processed, {values['failed']} failed")
+                last_report = timer()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+        for worker in workers:
+            worker.join(stop_timeout)
+            if worker.is_alive():
+                logger.warning(f"Killing {worker.name} after {stop_timeout}s")
+                worker.kill()
+                worker.join()
+
+    if not stopping:
+        logger.error(f"Crawler workers exited: {[worker.exitcode for worker in workers]}")
+        return 1
+    return 0
     
 async def initialize():
     await asyncio.gather(
@@ -198,6 +576,8 @@ def main():
     parser.add_argument("--initialize-artists", action="store_true")
     parser.add_argument("--initialize-albums", action="store_true")
     parser.add_argument("--initialize-spotify", action="store_true")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of crawler processes. Artist and album refreshes are split between them")
     
     args = parser.parse_args()
     
@@ -213,6 +593,9 @@ def main():
         asyncio.run(initialize_spotify())
         sys.exit()
     
+    if args.workers > 1:
+        sys.exit(run_workers(args.workers))
+
     asyncio.run(crawl())
     
 if __name__ == "__main__":
@@ -0,0 +1,318 @@
+"""
+Expires cached artists and albums when MusicBrainz changes, either in bulk from /invalidate
+or continuously from the change events the search indexer triggers publish
+"""
+import asyncio
+import collections
+import logging
+from timeit import default_timer as timer
+
+import aiohttp
+
+from lidarrmetadata import api
+from lidarrmetadata import cache
+from lidarrmetadata import config
+from lidarrmetadata import provider
+from lidarrmetadata import util
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+logger.info('Have invalidation logger')
+
+CONFIG = config.get_config()
+
+# Tables whose changes are followed, see changed_artists.sql and changed_albums.sql. These are
+# the ones the artist and release-group triggers from admin/setup-amqp-triggers publish that
+# feed into our responses. Tracks, links, aliases, tags and ratings aren't published by those
+# triggers, so changes to them are left to /invalidate and the crawler refreshing on expiry
+CHANGE_TABLES = {'artist', 'release_group', 'release'}
+
+def cloudflare_base_url():
+    """
+    Prefix of our urls in cloudflare. Includes the root path so each metadata version is kept separate
+    """
+    return CONFIG.CLOUDFLARE_URL_BASE + '/' + CONFIG.ROOT_PATH.lstrip('/').rstrip('/')
+
+def cloudflare_urls(artists=(), albums=(), spotify_artists=(), spotify_albums=()):
+    base_url = cloudflare_base_url()
+    return ([f'{base_url}/artist/{artist}' for artist in artists] +
+            [f'{base_url}/album/{album}' for album in albums] +
+            [f'{base_url}/spotify/artist/{spotify_artist}' for spotify_artist in spotify_artists] +
+            [f'{base_url}/spotify/album/{spotify_album}' for spotify_album in spotify_albums])
+
+async def invalidate_cloudflare(files):
+
+    zoneid = CONFIG.CLOUDFLARE_ZONE_ID
+    if not zoneid:
+        return
+
+    url = f'https://api.cloudflare.com/client/v4/zones/{zoneid}/purge_cache'
+    headers = {'X-Auth-Email': CONFIG.CLOUDFLARE_AUTH_EMAIL,
+               'X-Auth-Key': CONFIG.CLOUDFLARE_AUTH_KEY,
+               'Content-Type': 'application/json'}
+
+    async with aiohttp.ClientSession() as session:
+        # cloudflare only accepts 30 files at a time
+        for i in range(0, len(files), 30):
+            data = {'files': files[i:i+30]}
+            retries = 2
+
+            while retries > 0:
+                async with session.post(url, headers=headers, json=data) as r:
+                    logger.info(await r.text())
+                    json = await r.json()
+
+                    if json.get('success', False):
+                        break
+
+                    retries -= 1
+
+async def expire_entities(artists=(), albums=(), spotify_artists=(), spotify_albums=()):
+    """
+    Marks artists, albums and spotify maps as due for refreshing in the local caches. The
+    rendered responses of albums crediting the artists are expired too since they include them
+    """
+    ## Invalidate all the local caches together in one transaction
+    ## Existing entries keep their values to serve while refreshing, new items are added for the crawler
+    async with cache.transaction(util.ARTIST_CACHE, util.ALBUM_CACHE,
+                                 util.SPOTIFY_CACHE, util.RESPONSE_CACHE) as _conn:
+        await util.ARTIST_CACHE.multi_expire(list(artists), _conn=_conn)
+        await util.ALBUM_CACHE.multi_expire(list(albums), _conn=_conn)
+        # The spotify routes redirect to whatever mapping is cached regardless of expiry and
+        # nothing refreshes them, so these are blanked to be looked up again
+        await util.SPOTIFY_CACHE.multi_set([(spotify_artist, None) for spotify_artist in spotify_artists] +
+                                           [(spotify_album, None) for spotify_album in spotify_albums],
+                                           ttl=0, timeout=None, _conn=_conn)
+        await util.RESPONSE_CACHE.multi_expire([api.response_key(f'/artist/{artist}') for artist in artists] +
+                                               [api.response_key(f'/album/{album}') for album in albums],
+                                               add_missing=False, _conn=_conn)
+
+    # Artists can be credited on thousands of albums, so their responses are streamed in and
+    # expired a chunk at a time rather than holding the transaction open
+    async for album_responses in api.iterate_artist_release_group_ids(artists):
+        await util.RESPONSE_CACHE.multi_expire([api.response_key(f'/album/{album}') for album in album_responses],
+                                               add_missing=False)
+
+    # Memory caches are per process, so this only clears our own. Other workers keep serving
+    # their copies for up to MEMORY_CACHE_CONFIG's max_ttl, a minute by default
+    for artist in artists:
+        util.ARTIST_MEMORY_CACHE.delete(artist)
+    for album in albums:
+        util.ALBUM_MEMORY_CACHE.delete(album)
+
+# A change to one row of a MusicBrainz table. gid is only set for deleted artists and
+# release groups, which can't be looked up any more. message is the queue's own handle
+Change = collections.namedtuple('Change', ['table', 'id', 'gid', 'message'])
+
+def parse_change(body, message=None):
+    """
+    Parses a search indexer trigger message, a json object of the table name and the
+    row's key columns
+    :return: Change or None if the message isn't one
+    """
+    try:
+        data = util.json_loads(body)
+        # Tables may be qualified by schema
+        table = data['_table'].split('.')[-1]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+    return Change(table, data.get('id'), data.get('gid'), message)
+
+class LocalChangeQueue(object):
+    """
+    In-process stand in for the AMQP change queue, for tests and replaying changes by hand
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+
+    def publish(self, table, id=None, gid=None):
+        self._queue.put_nowait(Change(table, id, gid, None))
+
+    async def get(self):
+        return await self._queue.get()
+
+    async def ack(self, changes):
+        for _ in changes:
+            self._queue.task_done()
+
+    async def reject(self, changes):
+        for change in changes:
+            self._queue.put_nowait(change)
+            self._queue.task_done()
+
+    async def join(self):
+        await self._queue.join()
+
+class AmqpChangeQueue(object):
+    """
+    Reads the changes published to the search indexer's exchange by the triggers installed
+    with admin/setup-amqp-triggers, through a queue of our own so the indexer isn't affected
+    """
+
+    def __init__(self, url, exchange='search', queue='lidarr-metadata-changes', prefetch=1000):
+        self.url = url
+        self.exchange = exchange
+        self.queue = queue
+        self.prefetch = prefetch
+
+        self._connection = None
+        self._iterator = None
+
+    async def connect(self):
+        if aio_pika is None:
+            raise RuntimeError('aio-pika must be installed to read MusicBrainz changes from AMQP')
+
+        self._connection = await aio_pika.connect_robust(self.url)
+        channel = await self._connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch)
+
+        exchange = await channel.get_exchange(self.exchange)
+        queue = await channel.declare_queue(self.queue, durable=True)
+        for routing_key in ('index', 'delete'):
+            await queue.bind(exchange, routing_key)
+
+        self._iterator = queue.iterator()
+
+    async def close(self):
+        if self._connection:
+            try:
+                await self._connection.close()
+            except Exception as error:
+                logger.warning(f'Could not close AMQP connection: {error!r}')
+            self._connection = None
+
+    async def get(self):
+        while True:
+            message = await self._iterator.__anext__()
+            change = parse_change(message.body, message)
+            if change:
+                return change
+
+            logger.warning(f'Dropping unexpected change message: {message.body[:200]!r}')
+            await message.ack()
+
+    async def ack(self, changes):
+        for change in changes:
+            await change.message.ack()
+
+    async def reject(self, changes):
+        for change in changes:
+            await change.message.reject(requeue=True)
+
+class ChangeConsumer(object):
+    """
+    Expires the cached artists and albums affected by the MusicBrainz changes read from a
+    change queue and purges them from cloudflare. Changes are handled in batches of up to
+    batch_size, waiting at most batch_interval seconds for a batch to fill
+    """
+
+    def __init__(self, queue, musicbrainz, batch_size=500, batch_interval=5, retry_delay=30):
+        self.queue = queue
+        self.musicbrainz = musicbrainz
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.retry_delay = retry_delay
+
+    async def next_batch(self):
+        changes = [await self.queue.get()]
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_interval
+        while len(changes) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                changes.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return changes
+
+    async def resolve(self, changes):
+        """
+        :return: Tuple of (artist ids, release group ids) affected by changes
+        """
+        artists = set()
+        albums = set()
+        ids = collections.defaultdict(set)
+
+        for change in changes:
+            if change.gid and change.table == 'artist':
+                artists.add(change.gid)
+            elif change.gid and change.table == 'release_group':
+                albums.add(change.gid)
+            elif change.id is not None and change.table in CHANGE_TABLES:
+                ids[change.table].add(change.id)
+
+        results = await asyncio.gather(*(self.musicbrainz.get_changed_entities(table, sorted(table_ids))
+                                         for table, table_ids in ids.items()))
+        for table_artists, table_albums in results:
+            artists.update(table_artists)
+            albums.update(table_albums)
+
+        return artists, albums
+
+    async def process(self, changes):
+        start = timer()
+        artists, albums = await self.resolve(changes)
+
+        if artists or albums:
+            await expire_entities(artists, albums)
+            await invalidate_cloudflare(cloudflare_urls(artists, albums))
+
+        logger.info(f'Expired {len(artists)} artists and {len(albums)} albums for {len(changes)} changes '
+                    f'in {timer() - start:.1f}s')
+        return artists, albums
+
+    async def run(self):
+        while True:
+            changes = await self.next_batch()
+            try:
+                await self.process(changes)
+            except Exception:
+                logger.exception(f'Error handling {len(changes)} changes, retrying in {self.retry_delay}s')
+                await asyncio.sleep(self.retry_delay)
+                await self.queue.reject(changes)
+            else:
+                await self.queue.ack(changes)
+
+async def consume_changes(retry_delay=10, max_retry_delay=600):
+    """
+    Handles MusicBrainz changes from CONFIG.MB_CHANGES_AMQP_URL until cancelled. Connection and
+    broker errors are retried with backoff here so they don't stop the crawler's other jobs
+    """
+    if aio_pika is None:
+        logger.error('aio-pika is not installed, not reading MusicBrainz changes')
+        return
+
+    musicbrainz = provider.get_providers_implementing(provider.MusicbrainzDbProvider)[0]
+
+    delay = retry_delay
+    while True:
+        queue = AmqpChangeQueue(CONFIG.MB_CHANGES_AMQP_URL,
+                                exchange=CONFIG.MB_CHANGES_EXCHANGE,
+                                queue=CONFIG.MB_CHANGES_QUEUE,
+                                prefetch=CONFIG.MB_CHANGES_BATCH_SIZE * 2)
+        try:
+            await queue.connect()
+            delay = retry_delay
+            await ChangeConsumer(queue, musicbrainz,
+                                 batch_size=CONFIG.MB_CHANGES_BATCH_SIZE,
+                                 batch_interval=CONFIG.MB_CHANGES_BATCH_INTERVAL).run()
+        except Exception:
+            logger.exception(f'Reading MusicBrainz changes failed, reconnecting in {delay}s')
+        finally:
+            await queue.close()
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_retry_delay)
@@ -17,7 +17,6 @@ from urllib.parse import quote as url_quote
 import asyncio
 import aiohttp
 import asyncpg
-import json
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 
@@ -27,7 +26,7 @@ from lidarrmetadata.config import get_config
 from lidarrmetadata import limit
 from lidarrmetadata import stats
 from lidarrmetadata import util
-from lidarrmetadata.cache import conn
+from lidarrmetadata.cache import conn, check_pool
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -137,6 +136,7 @@ class ArtistByIdMixin(MixinBase):
     def get_all_spotify_mappings(self):
         """
         Grabs all link entities from database and parses for spotify maps
+        :return: Async iterator of dicts with mbid and spotifyid
         """
         pass
 
@@ -147,7 +147,12 @@ class ArtistIdListMixin(MixinBase):
     """
     
     @abc.abstractmethod
-    def get_all_artist_ids(self):
+    def get_artist_ids_after(self, after, limit):
+        """
+        Gets a page of artist ids in id order
+        :param after: Only return ids greater than this
+        :param limit: Maximum number of ids to return
+        """
         pass
 
 class ArtistNameSearchMixin(MixinBase):
@@ -239,7 +244,12 @@ class ReleaseGroupIdListMixin(MixinBase):
     """
     
     @abc.abstractmethod
-    def get_all_release_group_ids(self):
+    def get_release_group_ids_after(self, after, limit):
+        """
+        Gets a page of release group ids in id order
+        :param after: Only return ids greater than this
+        :param limit: Maximum number of ids to return
+        """
         pass
 
 
@@ -491,7 +501,7 @@ class HttpProvider(Provider,
                 if raise_on_http_error:
                     resp.raise_for_status()
 
-                json = await resp.json()
+                json = await resp.json(loads=util.json_loads)
                 return json
         except ValueError as error:
             logger.error(f'Response from {self._name} not valid json', extra=dict(error=error))
@@ -701,13 +711,28 @@ class FanArtTvProvider(HttpProvider,
             return handler(cached or {}), now + timedelta(seconds=CONFIG.CACHE_TTL['provider_error'])
         
     async def refresh_images(self, mbid):
-        try:
-            results = await self.get_by_mbid(mbid)
-            await self.cache_results(mbid, results)
+        await self.refresh_images_batch([mbid])
 
-        except (ProviderUnavailableException, ValueError):
-            logger.debug("Fanart unavailable")
-            await util.FANART_CACHE.expire(mbid, CONFIG.CACHE_TTL['provider_error'])
+    async def refresh_images_batch(self, mbids):
+        """
+        Refreshes the images for several mbids, writing everything fetched (including the
+        albums of any artists) to the cache in one go
+        """
+        async def fetch(mbid):
+            try:
+                return await self.get_cache_pairs(mbid, await self.get_by_mbid(mbid))
+            except (ProviderUnavailableException, ValueError):
+                logger.debug("Fanart unavailable")
+                return None
+
+        results = await asyncio.gather(*(fetch(mbid) for mbid in mbids))
+
+        # Keyed so an album shared between artists in the batch is only written once
+        pairs = {key: value for result in results if result for key, value in result[0]}
+        await util.FANART_CACHE.multi_set(list(pairs.items()), ttl=CONFIG.CACHE_TTL['fanart'])
+
+        failed = [mbid for mbid, result in zip(mbids, results) if result is None]
+        await asyncio.gather(*(util.FANART_CACHE.expire(mbid, CONFIG.CACHE_TTL['provider_error']) for mbid in failed))
         
     async def get_by_mbid(self, mbid):
         """
@@ -725,11 +750,19 @@ class FanArtTvProvider(HttpProvider,
     async def cache_results(self, mbid, results):
         ttl = CONFIG.CACHE_TTL['fanart']
 
+        pairs, results = await self.get_cache_pairs(mbid, results)
+        await util.FANART_CACHE.multi_set(pairs, ttl=ttl)
+
+        return results, ttl
+
+    async def get_cache_pairs(self, mbid, results):
+        """
+        Works out what to cache for a fanart response
+        :return: ([(key, value)] to cache, result for mbid)
+        """
         if results.get('mbid_id', None) == mbid:
             # This was a successful artist request, so cache albums also
-            await util.FANART_CACHE.set(mbid, results, ttl=ttl)
-            for id, album_result in results.get('albums', {}).items():
-                await util.FANART_CACHE.set(id, album_result, ttl=ttl)
+            pairs = [(mbid, results)] + list(results.get('albums', {}).items())
 
         else:
             # This was an album request or an unsuccessful artist request
@@ -743,9 +776,9 @@ class FanArtTvProvider(HttpProvider,
                 if cached:
                     results = cached
                 
-            await util.FANART_CACHE.set(mbid, results, ttl=ttl)
+            pairs = [(mbid, results)]
 
-        return results, ttl
+        return pairs, results
         
     async def invalidate_cache(self, prefix, since):
         logger.debug('Invalidating fanart cache')
@@ -1049,15 +1082,30 @@ class MusicbrainzDbProvider(Provider,
         self._db_password = db_password
         self._pool = None
         self.__pool_lock = None
+        self._stats = stats.TelegrafStatsClient(CONFIG.STATS_HOST,
+                                                CONFIG.STATS_PORT) if CONFIG.ENABLE_STATS else None
+
+        # Read the queries once rather than from disk on every call
+        self._queries = self._load_queries()
         
         ## dummy value for initialization, will be picked up from redis later on
         self._last_cache_invalidation = datetime.datetime.now(pytz.utc) - datetime.timedelta(hours = 2)
         
+    async def init_connection(self, con):
+        await self.uuid_as_str(con)
+        await self.json_as_object(con)
+
     async def uuid_as_str(self, con):
         await con.set_type_codec(
             'uuid', encoder=str, decoder=str,
             schema='pg_catalog', format='text'
         )
+
+    async def json_as_object(self, con):
+        await con.set_type_codec(
+            'json', encoder=lambda value: util.json_dumps(value).decode('utf-8'), decoder=util.json_loads,
+            schema='pg_catalog', format='text'
+        )
         
     @property
     def _pool_lock(self):
@@ -1077,10 +1125,26 @@ class MusicbrainzDbProvider(Provider,
                                                        user = self._db_user,
                                                        password = self._db_password,
                                                        database = self._db_name,
-                                                       init = self.uuid_as_str,
-                                                       statement_cache_size=0)
+                                                       init = self.init_connection,
+                                                       statement_cache_size=CONFIG.MB_DB_STATEMENT_CACHE_SIZE,
+                                                       **CONFIG.MB_DB_POOL_CONFIG)
                 
             return self._pool
+
+    async def warm_up(self):
+        """
+        Opens the pool's connections ahead of the first query
+        """
+        await self._get_pool()
+
+    async def check_connections(self, timeout=5):
+        """
+        Checks an idle connection, replacing it if broken
+        :return: Number of connections replaced
+        """
+        if self._pool is None:
+            return 0
+        return await check_pool(self._pool, timeout)
         
     async def data_vintage(self):
         data = await self.query_from_file('data_vintage.sql')
@@ -1097,15 +1161,21 @@ class MusicbrainzDbProvider(Provider,
         if vintage > self._last_cache_invalidation:
             logger.debug('Invalidating musicbrainz cache')
 
-            result['artists'] = await self._invalidate_queries_by_entity_id('updated_artists.sql')
-            result['albums'] = await self._invalidate_queries_by_entity_id('updated_albums.sql')
-            result['spotify_artists'] = await self._invalidate_spotify_ids('updated_spotify_artists.sql')
-            result['spotify_albums'] = await self._invalidate_spotify_ids('updated_spotify_albums.sql')
-            
-            logger.info('Invalidating these artists given musicbrainz updates:\n{}'.format('\n'.join(result['artists'])))
-            logger.info('Invalidating these albums given musicbrainz updates:\n{}'.format('\n'.join(result['albums'])))
-            logger.info('Invalidating these spotify artists given musicbrainz updates:\n{}'.format('\n'.join(result['spotify_artists'])))
-            logger.info('Invalidating these spotify albums given musicbrainz updates:\n{}'.format('\n'.join(result['spotify_albums'])))
+            # Each query gets its own pool connection so they run side by side
+            start = timer()
+            (result['artists'],
+             result['albums'],
+             result['spotify_artists'],
+             result['spotify_albums']) = await asyncio.gather(
+                 self._invalidate_queries_by_entity_id('updated_artists.sql'),
+                 self._invalidate_queries_by_entity_id('updated_albums.sql'),
+                 self._invalidate_spotify_ids('updated_spotify_artists.sql'),
+                 self._invalidate_spotify_ids('updated_spotify_albums.sql')
+            )
+
+            logger.info(f"Invalidating {len(result['artists'])} artists, {len(result['albums'])} albums, "
+                        f"{len(result['spotify_artists'])} spotify artists and {len(result['spotify_albums'])} "
+                        f"spotify albums given musicbrainz updates in {timer() - start:.1f}s")
 
             await util.CACHE.set(last_invalidation_key, vintage)
         else:
@@ -1113,13 +1183,33 @@ class MusicbrainzDbProvider(Provider,
             
         return result
     
+    async def _invalidate_ids(self, changed_query, column):
+        start = timer()
+        rows = 0
+        ids = set()
+        async for entity in self.iterate_query_from_file(changed_query, self._last_cache_invalidation):
+            rows += 1
+            ids.add(entity[column])
+
+        logger.info(f"Invalidation query {changed_query} returned {rows} rows, {len(ids)} ids in {timer() - start:.1f}s")
+        return ids
+
     async def _invalidate_queries_by_entity_id(self, changed_query):
-        entities = await self.query_from_file(changed_query, self._last_cache_invalidation)
-        return [entity['gid'] for entity in entities]
+        return await self._invalidate_ids(changed_query, 'gid')
+
+    async def get_changed_entities(self, table, ids):
+        """
+        Finds the artists and release groups whose responses depend on some rows of a table
+        :param table: MusicBrainz table name
+        :param ids: Ids of the rows that changed
+        :return: Tuple of (artist ids, release group ids)
+        """
+        artists, albums = await asyncio.gather(self.query_from_file('changed_artists.sql', table, ids),
+                                               self.query_from_file('changed_albums.sql', table, ids))
+        return [item['gid'] for item in artists], [item['gid'] for item in albums]
 
     async def _invalidate_spotify_ids(self, changed_query):
-        entities = await self.query_from_file(changed_query, self._last_cache_invalidation)
-        return [entity['spotifyid'] for entity in entities]
+        return await self._invalidate_ids(changed_query, 'spotifyid')
     
     async def get_artists_by_id(self, artist_ids):
         artists = await self.query_from_file('artist_by_id.sql', artist_ids)
@@ -1129,7 +1219,8 @@ class MusicbrainzDbProvider(Provider,
         if not artists:
             return None
         
-        artists = [self._load_artist(item['artist']) for item in artists]
+        # Links are classified in SQL and the json codec has already parsed the documents
+        artists = [item['artist'] for item in artists]
 
         return artists
         
@@ -1146,57 +1237,13 @@ class MusicbrainzDbProvider(Provider,
         return None
 
     async def get_all_spotify_mappings(self):
-        return await self.query_from_file('all_spotify_maps.sql')
-        # return results
-        # return [{'mbid': item['gid'], 'spotifyid': item['spotifyid']} for item in results]
+        async for item in self.iterate_query_from_file('all_spotify_maps.sql'):
+            yield item
     
-    async def get_all_artist_ids(self):
-        results = await self.query_from_file('all_artist_ids.sql')
+    async def get_artist_ids_after(self, after, limit):
+        results = await self.query_from_file('artist_ids_after.sql', after, limit)
         return [item['gid'] for item in results]
 
-    @staticmethod
-    def _build_caa_url(release_id, image_id):
-        return 'https://imagecache.lidarr.audio/v1/caa/{}/{}-1200.jpg'.format(release_id, image_id)
-    
-    @classmethod
-    def _load_artist(cls, data):
-        # Load the json from postgres
-        artist = json.loads(data)
-        
-        # parse the links
-        artist['links'] = [{
-            'target': link,
-            'type': cls.parse_url_source(link)
-        } for link in artist['links']]
-        
-        return artist
-
-    @classmethod
-    def _load_release_group(cls, data):
-        # Load the json from postgres
-        release_group = json.loads(data)
-        
-        # parse the links
-        release_group['links'] = [{
-            'target': link,
-            'type': cls.parse_url_source(link)
-        } for link in release_group['links']]
-        
-        # parse caa images
-        if release_group['images']:
-            type_mapping = {'Front': 'Cover', 'Medium': 'Disc'}
-
-            art = {}
-            for result in release_group['images']:
-                cover_type = type_mapping.get(result['type'], None)
-                if cover_type is not None and cover_type not in art:
-                    art[cover_type] = cls._build_caa_url(result['release_gid'], result['image_id'])
-            release_group['images'] = [{'CoverType': art_type, 'Url': url} for art_type, url in art.items()]
-        else:
-            release_group['images'] = []
-            
-        return release_group
-
     async def get_release_groups_by_id(self, rgids):
         release_groups = await self.query_from_file('release_group_by_id.sql', rgids)
         
@@ -1205,7 +1252,8 @@ class MusicbrainzDbProvider(Provider,
         if not release_groups:
             return None
         
-        release_groups = [self._load_release_group(item['album']) for item in release_groups]
+        # Links and images are built in SQL and the json codec has already parsed the documents
+        release_groups = [item['album'] for item in release_groups]
 
         return release_groups
 
@@ -1226,10 +1274,14 @@ class MusicbrainzDbProvider(Provider,
             return results[0]['gid']
         return None
     
-    async def get_all_release_group_ids(self):
-        results = await self.query_from_file('all_release_group_ids.sql')
+    async def get_release_group_ids_after(self, after, limit):
+        results = await self.query_from_file('release_group_ids_after.sql', after, limit)
         return [item['gid'] for item in results]
 
+    async def iterate_artist_release_group_ids(self, artist_ids):
+        async for item in self.iterate_query_from_file('artist_release_group_ids.sql', artist_ids):
+            yield item['gid']
+
     async def get_release_groups_by_artist(self, artist_id):
         results = await self.query_from_file('release_group_search_artist_mbid.sql', artist_id)
         
@@ -1245,8 +1297,22 @@ class MusicbrainzDbProvider(Provider,
 
     async def get_series(self, mbid):
         series = await self.query_from_file('release_group_series.sql', mbid)
-        return [json.loads(x['item']) for x in series]
+        return [x['item'] for x in series]
     
+    @staticmethod
+    def _load_queries():
+        """
+        Reads all the sql files in lidarrmetadata.sql
+        :return: Dict of filename: query
+        """
+        return {sql_file: pkg_resources.resource_string('lidarrmetadata.sql', sql_file).decode('utf-8')
+                for sql_file in pkg_resources.resource_listdir('lidarrmetadata.sql', '')
+                if sql_file.endswith('.sql')}
+
+    def _record_query_time(self, sql_file, elapsed):
+        if self._stats:
+            self._stats.metric('mb_query', {'query_time': elapsed}, tags={'query': sql_file})
+
     async def query_from_file(self, sql_file, *args):
         """
         Executes query from sql file
@@ -1255,10 +1321,42 @@ class MusicbrainzDbProvider(Provider,
         :param kwargs: Keyword args to pass to cursor.execute
         :return: List of dict with column: value results
         """
-        filename = pkg_resources.resource_filename('lidarrmetadata.sql', sql_file)
+        start = timer()
+        results = await self.map_query(self._queries[sql_file], *args)
+        elapsed = int((timer() - start) * 1000)
+
+        logger.debug(f"Query {sql_file} returned {len(results)} rows in {elapsed}ms")
+        self._record_query_time(sql_file, elapsed)
+
+        return results
+
+    async def iterate_query_from_file(self, sql_file, *args, prefetch=None):
+        """
+        As query_from_file but yields rows as they are read using iterate_query
+        """
+        start = timer()
+        count = 0
+        async for row in self.iterate_query(self._queries[sql_file], *args, prefetch=prefetch):
+            count += 1
+            yield row
+        elapsed = int((timer() - start) * 1000)
 
-        with open(filename, 'r') as sql:
-            return await self.map_query(sql.read(), *args)
+        logger.debug(f"Query {sql_file} streamed {count} rows in {elapsed}ms")
+        self._record_query_time(sql_file, elapsed)
+
+    async def iterate_query(self, sql, *args, prefetch=None):
+        """
+        As map_query but yields the rows from a server side cursor, fetching prefetch rows at
+        a time, so large results never have to fit in memory
+        :param args: Args to pass to the cursor
+        :param prefetch: Rows to fetch per round trip. Defaults to MB_DB_CURSOR_PREFETCH
+        """
+        pool = await self._get_pool()
+        async with pool.acquire() as _conn:
+            # Cursors only exist inside a transaction
+            async with _conn.transaction():
+                async for row in _conn.cursor(sql, *args, prefetch=prefetch or CONFIG.MB_DB_CURSOR_PREFETCH):
+                    yield dict(row.items())
 
     @conn
     async def map_query(self, sql, *args, _conn=None):
@@ -1275,20 +1373,6 @@ class MusicbrainzDbProvider(Provider,
 
         return results
 
-    @staticmethod
-    def parse_url_source(url):
-        """
-        Parses URL for name
-        :param url: URL to parse
-        :return: Website name of url
-        """
-        domain = url.split('/')[2]
-        split_domain = domain.split('.')
-        try:
-            return split_domain[-2] if split_domain[-2] != 'co' else split_domain[-3]
-        except IndexError:
-            return domain
-
 class SpotifyProvider(Provider,
                       SpotifyIdMixin):
     """
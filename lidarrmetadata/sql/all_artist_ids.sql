@@ -1,2 +0,0 @@
-SELECT artist.gid
-FROM artist
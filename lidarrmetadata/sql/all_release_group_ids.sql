@@ -1,2 +0,0 @@
-SELECT release_group.gid
-FROM release_group
@@ -24,9 +24,20 @@ SELECT
         'Value', artist_meta.rating::decimal / 10
       ) AS Rating,
       array(
-        SELECT url.url
+        SELECT json_build_object(
+          'target', url.url,
+          -- Name the site after the second level domain, skipping 'co' as in 'co.uk'
+          'type', CASE
+            WHEN cardinality(labels) < 2 THEN url_domain
+            WHEN labels[cardinality(labels) - 1] != 'co' THEN labels[cardinality(labels) - 1]
+            WHEN cardinality(labels) < 3 THEN url_domain
+            ELSE labels[cardinality(labels) - 2]
+          END
+        )
           FROM url
                  JOIN l_artist_url ON l_artist_url.entity0 = artist.id AND l_artist_url.entity1 = url.id
+                 CROSS JOIN LATERAL split_part(url.url, '/', 3) AS url_domain
+                 CROSS JOIN LATERAL string_to_array(url_domain, '.') AS labels
       ) AS Links,
       array(
         SELECT INITCAP(genre.name)
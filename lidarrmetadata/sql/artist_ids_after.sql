@@ -0,0 +1,5 @@
+SELECT artist.gid
+FROM artist
+WHERE artist.gid > $1
+ORDER BY artist.gid
+LIMIT $2
@@ -0,0 +1,6 @@
+-- Release groups credited to any of the artists $1, whose responses include those artists
+SELECT DISTINCT release_group.gid
+  FROM release_group
+         JOIN artist_credit_name ON artist_credit_name.artist_credit = release_group.artist_credit
+         JOIN artist ON artist_credit_name.artist = artist.id
+ WHERE artist.gid = ANY($1::uuid[])
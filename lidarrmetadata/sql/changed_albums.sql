@@ -0,0 +1,13 @@
+-- Release groups affected by changes to rows $2 of table $1, following updated_albums.sql
+SELECT release_group.gid
+  FROM release_group
+ WHERE $1::text = 'release_group'
+   AND release_group.id = ANY($2::integer[])
+
+ UNION
+
+SELECT release_group.gid
+  FROM release_group
+         JOIN release ON release.release_group = release_group.id
+ WHERE $1::text = 'release'
+   AND release.id = ANY($2::integer[])
@@ -0,0 +1,28 @@
+-- Artists affected by changes to rows $2 of table $1, following updated_artists.sql
+SELECT artist.gid
+  FROM artist
+ WHERE $1::text = 'artist'
+   AND artist.id = ANY($2::integer[])
+
+       UNION
+
+  -- artist release group changed (basic rg info gets returned as part of artist query)
+SELECT artist.gid
+  FROM artist
+         JOIN artist_credit_name ON artist_credit_name.artist = artist.id
+         JOIN release_group ON release_group.artist_credit = artist_credit_name.artist_credit
+ WHERE $1::text = 'release_group'
+   AND artist_credit_name.position = 0
+   AND release_group.id = ANY($2::integer[])
+
+       UNION
+
+  -- artist release changed (release group status is calculated from releases and returned in artist query)
+SELECT artist.gid
+  FROM artist
+         JOIN artist_credit_name ON artist_credit_name.artist = artist.id
+         JOIN release_group ON release_group.artist_credit = artist_credit_name.artist_credit
+         JOIN release ON release.release_group = release_group.id
+ WHERE $1::text = 'release'
+   AND artist_credit_name.position = 0
+   AND release.id = ANY($2::integer[])
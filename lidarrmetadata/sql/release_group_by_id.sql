@@ -69,9 +69,20 @@ SELECT
         'Value', release_group_meta.rating::decimal / 10
       ) AS Rating,
       array(
-        SELECT url.url
+        SELECT json_build_object(
+          'target', url.url,
+          -- Name the site after the second level domain, skipping 'co' as in 'co.uk'
+          'type', CASE
+            WHEN cardinality(labels) < 2 THEN url_domain
+            WHEN labels[cardinality(labels) - 1] != 'co' THEN labels[cardinality(labels) - 1]
+            WHEN cardinality(labels) < 3 THEN url_domain
+            ELSE labels[cardinality(labels) - 2]
+          END
+        )
           FROM url
                  JOIN l_release_group_url ON l_release_group_url.entity0 = release_group.id AND l_release_group_url.entity1 = url.id
+                 CROSS JOIN LATERAL split_part(url.url, '/', 3) AS url_domain
+                 CROSS JOIN LATERAL string_to_array(url_domain, '.') AS labels
       ) AS Links,
       array(
         SELECT INITCAP(genre.name)
@@ -82,17 +93,25 @@ SELECT
            AND release_group_tag.count > 0
       ) AS Genres,
       (
-	SELECT
-	  json_agg(row_to_json(images_data))
-	  FROM (
-	    SELECT unnest(types) AS type,
-		   release.gid AS release_gid,
-		   index_listing.id AS image_id
-	      FROM cover_art_archive.index_listing
-		     JOIN release ON index_listing.release = release.id
-	     WHERE release.release_group = release_group.id
-	     ORDER BY index_listing.ordering ASC
-	  ) images_data
+        SELECT
+          COALESCE(json_agg(json_build_object('CoverType', cover_type, 'Url', url)
+                            ORDER BY ordering, image_id, type_position), '[]'::json)
+          FROM (
+            -- First image of each type we use, ties broken by image id so the choice is stable
+            SELECT DISTINCT ON (cover_type)
+              cover_type,
+              index_listing.ordering,
+              index_listing.id AS image_id,
+              image_type.position AS type_position,
+              'https://imagecache.lidarr.audio/v1/caa/' || release.gid || '/' || index_listing.id || '-1200.jpg' AS url
+              FROM cover_art_archive.index_listing
+                     JOIN release ON index_listing.release = release.id
+                     CROSS JOIN LATERAL unnest(index_listing.types) WITH ORDINALITY AS image_type(type, position)
+                     JOIN (VALUES ('Front', 'Cover'), ('Medium', 'Disc')) AS type_mapping(type, cover_type)
+                         ON type_mapping.type = image_type.type
+             WHERE release.release_group = release_group.id
+             ORDER BY cover_type, index_listing.ordering ASC, index_listing.id ASC
+          ) images_data
       ) AS images,
       (
         SELECT
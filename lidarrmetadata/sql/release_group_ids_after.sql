@@ -0,0 +1,5 @@
+SELECT release_group.gid
+FROM release_group
+WHERE release_group.gid > $1
+ORDER BY release_group.gid
+LIMIT $2
@@ -8,6 +8,8 @@ import logging
 
 import functools
 import redis
+import orjson
+import quart.json
 from aiocache import caches
 from aiocache.backends.redis import RedisCache
 
@@ -36,6 +38,55 @@ WIKI_CACHE = caches.get('wikipedia')
 ARTIST_CACHE = caches.get('artist')
 ALBUM_CACHE = caches.get('album')
 SPOTIFY_CACHE = caches.get('spotify')
+# Rendered JSON bodies for the unfiltered artist and album routes
+RESPONSE_CACHE = caches.get('response')
+
+POSTGRES_CACHES = [item for item in (FANART_CACHE, TADB_CACHE, WIKI_CACHE, ARTIST_CACHE, ALBUM_CACHE, SPOTIFY_CACHE, RESPONSE_CACHE)
+                   if isinstance(item, cache.PostgresBackend)]
+
+# Sampled request counts for refreshing popular artists and albums first
+ARTIST_HITS = cache.HitCounter(ARTIST_CACHE, CONFIG.CACHE_HIT_SAMPLE_RATE)
+ALBUM_HITS = cache.HitCounter(ALBUM_CACHE, CONFIG.CACHE_HIT_SAMPLE_RATE)
+
+# In-process caches in front of the artist and album caches
+if CONFIG.USE_CACHE:
+    ARTIST_MEMORY_CACHE = cache.MemoryCache(**CONFIG.MEMORY_CACHE_CONFIG['artist'])
+    ALBUM_MEMORY_CACHE = cache.MemoryCache(**CONFIG.MEMORY_CACHE_CONFIG['album'])
+else:
+    ARTIST_MEMORY_CACHE = cache.MemoryCache(max_size=0)
+    ALBUM_MEMORY_CACHE = cache.MemoryCache(max_size=0)
+
+def json_dumps(value, default=None):
+    """
+    Serializes value to compact JSON with sorted keys
+    :param value: Value to serialize
+    :param default: Function converting objects that can't otherwise be serialized
+    :return: UTF-8 encoded bytes
+    """
+    return orjson.dumps(value, default=default,
+                        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+def json_loads(data):
+    """
+    Parses JSON from str or bytes
+    """
+    return orjson.loads(data)
+
+class JSONEncoder(quart.json.JSONEncoder):
+    """
+    Quart JSON encoder using json_dumps for compact output
+    """
+    def encode(self, o):
+        if self.indent is None and self.sort_keys:
+            return json_dumps(o, default=self.default).decode('utf-8')
+        return super().encode(o)
+
+class JSONDecoder(quart.json.JSONDecoder):
+    """
+    Quart JSON decoder using json_loads
+    """
+    def decode(self, s):
+        return json_loads(s)
 
 def first_key_item(dictionary, key, default=None):
     """
@@ -0,0 +1,95 @@
+"""
+Script to compare stdlib json with orjson on artist and album shaped documents.
+"""
+
+import argparse
+import json
+import random
+import string
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from benchmark_serializers import synthetic_artist
+
+
+def random_text(length):
+    return ''.join(random.choice(string.ascii_letters + ' ') for _ in range(length))
+
+
+def synthetic_album(releases=30, tracks=15):
+    return {
+        'id': '5b11f4ce-a62d-471e-81fc-a69a8278c7da',
+        'title': 'Nevermind',
+        'disambiguation': '',
+        'type': 'Album',
+        'secondarytypes': [],
+        'releasedate': '1991-09-24',
+        'artistids': ['5b11f4ce-a62d-471e-81fc-a69a8278c7da'],
+        'rating': {'Count': 10, 'Value': 9.1},
+        'genres': ['grunge', 'alternative rock'],
+        'aliases': [],
+        'links': [{'target': f'https://example.com/{random_text(10)}', 'type': 'discogs'} for _ in range(20)],
+        'images': [{'CoverType': 'Cover', 'Url': f'https://imagecache.lidarr.audio/{random_text(30)}.jpg'}],
+        'overview': random_text(1000),
+        'releases': [{
+            'id': f'{i:08d}-0000-0000-0000-000000000000',
+            'title': 'Nevermind',
+            'status': 'Official',
+            'country': ['United States'],
+            'label': [random_text(15)],
+            'media': [{'Format': 'CD', 'Name': '', 'Position': 1}],
+            'releasedate': '1991-09-24',
+            'track_count': tracks,
+            'tracks': [{
+                'id': f'{i:08d}-{j:04d}-0000-0000-000000000000',
+                'recordingid': f'{i:08d}-{j:04d}-0000-0000-000000000001',
+                'artistid': '5b11f4ce-a62d-471e-81fc-a69a8278c7da',
+                'trackname': random_text(20),
+                'tracknumber': str(j + 1),
+                'trackposition': j + 1,
+                'mediumnumber': 1,
+                'durationms': 200000 + j
+            } for j in range(tracks)]
+        } for i in range(releases)]
+    }
+
+
+def stdlib_dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(value):
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+
+
+def benchmark(name, dumps, loads, value, number):
+    encoded = dumps(value)
+
+    dumps_time = timeit.timeit(lambda: dumps(value), number=number) * 1e6 / number
+    loads_time = timeit.timeit(lambda: loads(encoded), number=number) * 1e6 / number
+
+    print(f"{name:<20} {dumps_time:>10.1f} {loads_time:>10.1f} {len(encoded):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare JSON libraries')
+    parser.add_argument('--number', type=int, default=200, help='Number of timing repetitions')
+    args = parser.parse_args()
+
+    documents = {'artist': synthetic_artist(), 'album': synthetic_album()}
+
+    print(f"{'document/library':<20} {'dumps (us)':>10} {'loads (us)':>10} {'bytes':>10}")
+    for name, document in documents.items():
+        benchmark(f'{name}/json', stdlib_dumps, json.loads, document, args.number)
+        if orjson:
+            benchmark(f'{name}/orjson', orjson_dumps, orjson.loads, document, args.number)
+        else:
+            print(f'{name}/orjson            not installed')
+
+
+if __name__ == "__main__":
+    main()
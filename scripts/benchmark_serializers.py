@@ -0,0 +1,96 @@
+"""
+Script to compare the cache serializers on encode/decode time and stored size.
+
+Uses a synthetic artist by default, or real values from a postgres cache table with --table.
+"""
+
+import argparse
+import asyncio
+import random
+import string
+import timeit
+
+from aiocache.serializers import PickleSerializer
+
+from lidarrmetadata.cache import CompressionSerializer, VersionedSerializer
+
+HOST = "127.0.0.1"
+PORT = 5432
+USER = ""
+PASSWORD = ""
+DB = "lm_cache_db"
+
+
+def random_text(length):
+    return ''.join(random.choice(string.ascii_letters + ' ') for _ in range(length))
+
+
+def synthetic_artist(aliases=200, links=100, albums=300):
+    return {
+        'id': '65f4f0c5-ef9e-490c-aee3-909e7ae6b2ab',
+        'artistname': 'Metallica',
+        'sortname': 'Metallica',
+        'disambiguation': '',
+        'type': 'Group',
+        'status': 'active',
+        'rating': {'Count': 10, 'Value': 9.1},
+        'genres': ['thrash metal', 'heavy metal'],
+        'artistaliases': [random_text(20) for _ in range(aliases)],
+        'oldids': [],
+        'links': [{'target': f'https://example.com/{random_text(10)}', 'type': 'discogs'} for _ in range(links)],
+        'images': [{'CoverType': 'Poster', 'Url': f'https://assets.fanart.tv/{random_text(30)}.jpg'}],
+        'overview': random_text(2000),
+        'albums': [{'Id': f'{i:08d}-0000-0000-0000-000000000000', 'Title': random_text(20), 'Type': 'Album',
+                    'SecondaryTypes': [], 'ReleaseStatuses': ['Official']} for i in range(albums)]
+    }
+
+
+async def get_values(table, count):
+    import asyncpg
+
+    conn = await asyncpg.connect(f"postgresql://{USER}:{PASSWORD}@{HOST}:{PORT}/{DB}")
+    rows = await conn.fetch(f"SELECT value FROM {table} WHERE value IS NOT NULL LIMIT $1;", count)
+    await conn.close()
+
+    serializer = VersionedSerializer()
+    return [serializer.loads(row['value']) for row in rows]
+
+
+def benchmark(name, serializer, values, number):
+    encoded = [serializer.dumps(value) for value in values]
+    size = sum(len(item) for item in encoded)
+
+    dumps = timeit.timeit(lambda: [serializer.dumps(value) for value in values], number=number)
+    loads = timeit.timeit(lambda: [serializer.loads(item) for item in encoded], number=number)
+    per_value = 1e6 / (number * len(values))
+
+    print(f"{name:<24} {dumps * per_value:>10.1f} {loads * per_value:>10.1f} {size / len(values):>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare cache serializers')
+    parser.add_argument('--table', help='Benchmark values from this postgres cache table')
+    parser.add_argument('--count', type=int, default=1000, help='Number of values to read from --table')
+    parser.add_argument('--number', type=int, default=100, help='Number of timing repetitions')
+    args = parser.parse_args()
+
+    if args.table:
+        values = asyncio.run(get_values(args.table, args.count))
+    else:
+        values = [synthetic_artist()]
+
+    serializers = {
+        'pickle (current)': PickleSerializer(),
+        'pickle + zlib (redis)': CompressionSerializer(),
+        'versioned pickle': VersionedSerializer(codec='pickle'),
+        'versioned marshal': VersionedSerializer(codec='marshal'),
+        'versioned marshal + zlib': VersionedSerializer(codec='marshal', compress_threshold=1024)
+    }
+
+    print(f"{'serializer':<24} {'dumps (us)':>10} {'loads (us)':>10} {'bytes/value':>12}")
+    for name, serializer in serializers.items():
+        benchmark(name, serializer, values, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,11 @@ Script to expire TADB cache entries. Can be adapted for other cache expiration t
 """
 
 import asyncio
-import pickle
 
 import asyncpg
 
+from lidarrmetadata.cache import VersionedSerializer
+
 HOST = "127.0.0.1"
 PORT = 5432
 USER = ""
@@ -14,8 +15,11 @@ PASSWORD = ""
 DB = "lm_cache_db"
 
 
+SERIALIZER = VersionedSerializer()
+
+
 def decode_value(v):
-    return pickle.loads(v)
+    return SERIALIZER.loads(v)
 
 
 def contains_tadb(v):
@@ -2,6 +2,9 @@
 Tests api functionality
 """
 
+import asyncio
+import datetime
+
 import pytest
 import quart
 
@@ -28,3 +31,225 @@ async def test_get_search_query_blank():
         with pytest.raises(quart.exceptions.BadRequest) as e:
             lidarrmetadata.app.get_search_query()
             assert e.code == 400
+
+
+class FakeCache:
+    """
+    Minimal stand in for a PostgresCache holding (value, expiry) tuples
+    """
+    def __init__(self, items=None):
+        self.items = items or {}
+        self.reads = 0
+
+    async def get(self, key):
+        self.reads += 1
+        return self.items.get(key, (None, lidarrmetadata.provider.utcnow()))
+
+    async def multi_get(self, keys):
+        self.reads += 1
+        return [self.items.get(key, (None, lidarrmetadata.provider.utcnow())) for key in keys]
+
+    async def set(self, key, value, ttl=None):
+        self.items[key] = (value, lidarrmetadata.provider.utcnow() + datetime.timedelta(seconds=ttl))
+
+    async def multi_set_expiring(self, items):
+        for key, value, expiry in items:
+            self.items[key] = (value, expiry)
+
+
+@pytest.mark.asyncio
+async def test_get_cached_batch():
+    expiry = lidarrmetadata.provider.utcnow() + datetime.timedelta(days=1)
+    cache = FakeCache({'a': ({'id': 'a'}, expiry)})
+    built = []
+
+    async def multi_function(mbids):
+        built.append(mbids)
+        return [({'id': mbid}, expiry) for mbid in mbids if mbid != 'old']
+
+    @lidarrmetadata.api.postgres_cache(cache)
+    async def function(mbid):
+        if mbid == 'old':
+            return {'id': 'new'}, expiry
+        raise lidarrmetadata.api.ArtistNotFoundException(mbid)
+
+    results = await lidarrmetadata.api.get_cached_batch(function, multi_function, ['c', 'a', 'b', 'old', 'a'])
+
+    assert ['c', 'a', 'b', 'new', 'a'] == [result['id'] for result, _ in results]
+    assert [['c', 'b', 'old']] == built
+    assert {'a', 'b', 'c', 'old'} == set(cache.items.keys())
+
+
+@pytest.mark.asyncio
+async def test_get_cached_batch_return_exceptions():
+    expiry = lidarrmetadata.provider.utcnow() + datetime.timedelta(days=1)
+
+    async def multi_function(mbids):
+        return [({'id': 'a'}, expiry)]
+
+    @lidarrmetadata.api.postgres_cache(FakeCache())
+    async def function(mbid):
+        raise lidarrmetadata.api.ArtistNotFoundException(mbid)
+
+    results = await lidarrmetadata.api.get_cached_batch(function, multi_function, ['a', 'b'], return_exceptions=True)
+
+    assert 'a' == results[0][0]['id']
+    assert isinstance(results[1], lidarrmetadata.api.ArtistNotFoundException)
+
+    with pytest.raises(lidarrmetadata.api.ArtistNotFoundException):
+        await lidarrmetadata.api.get_cached_batch(function, multi_function, ['a', 'b'])
+
+
+def test_get_search_result():
+    expiry = lidarrmetadata.provider.utcnow()
+    get_search_result = lidarrmetadata.app.get_search_result
+
+    assert ({'id': 'a'}, 10, expiry) == get_search_result(({'id': 'a'}, expiry), 10, lidarrmetadata.api.ArtistNotFoundException)
+    assert (None, -1) == get_search_result(lidarrmetadata.api.ArtistNotFoundException('a'), 10,
+                                           lidarrmetadata.api.ArtistNotFoundException)[:2]
+
+    with pytest.raises(ValueError):
+        get_search_result(ValueError(), 10, lidarrmetadata.api.ArtistNotFoundException)
+
+
+@pytest.mark.asyncio
+async def test_render_response_matches_jsonify():
+    value = {'b': 1, 'a': ['Motörhead', None, 1.5], 'c': {'z': True, 'y': 'x'}}
+
+    async with lidarrmetadata.app.app.app_context():
+        expected = await quart.jsonify(value).get_data()
+
+    assert expected == lidarrmetadata.api.render_response(value)
+
+
+@pytest.mark.asyncio
+async def test_get_cached_response_coalesces_misses(monkeypatch):
+    monkeypatch.setattr(lidarrmetadata.util, 'RESPONSE_CACHE', FakeCache())
+    expiry = lidarrmetadata.provider.utcnow() + datetime.timedelta(days=1)
+    calls = []
+
+    async def function(mbid):
+        calls.append(mbid)
+        await asyncio.sleep(0.01)
+        return {'id': mbid}, expiry
+
+    results = await asyncio.gather(*[lidarrmetadata.api.get_cached_response('/artist/a', function, 'a')
+                                     for _ in range(5)])
+
+    assert ['a'] == calls
+    body = lidarrmetadata.api.render_response({'id': 'a'})
+    assert [(body, expiry)] * 5 == results
+
+    assert results[0] == await lidarrmetadata.api.get_cached_response('/artist/a', function, 'a')
+    assert ['a'] == calls
+
+
+@pytest.mark.asyncio
+async def test_get_cached_batch_coalesces_misses():
+    expiry = lidarrmetadata.provider.utcnow() + datetime.timedelta(days=1)
+    cache = FakeCache()
+    built = []
+
+    async def multi_function(mbids):
+        built.extend(mbids)
+        await asyncio.sleep(0.01)
+        return [({'id': mbid}, expiry) for mbid in mbids]
+
+    @lidarrmetadata.api.postgres_cache(cache)
+    async def function(mbid):
+        return (await multi_function([mbid]))[0]
+
+    results = await asyncio.gather(function('a'),
+                                   lidarrmetadata.api.get_cached_batch(function, multi_function, ['a', 'b']),
+                                   lidarrmetadata.api.get_cached_batch(function, multi_function, ['b', 'c']))
+
+    assert 'a' == results[0][0]['id']
+    assert ['a', 'b'] == [result['id'] for result, _ in results[1]]
+    assert ['b', 'c'] == [result['id'] for result, _ in results[2]]
+    assert ['a', 'b', 'c'] == sorted(built)
+
+
+@pytest.mark.asyncio
+async def test_postgres_cache_serves_stale(monkeypatch):
+    monkeypatch.setattr(lidarrmetadata.api.CONFIG, 'USE_CACHE', False)
+    monkeypatch.setattr(lidarrmetadata.api.CONFIG, 'CACHE_STALE_GRACE', 3600)
+    now = lidarrmetadata.provider.utcnow()
+    cache = FakeCache({'a': ({'id': 'a', 'version': 1}, now - datetime.timedelta(seconds=10))})
+    release = asyncio.Event()
+    calls = []
+
+    @lidarrmetadata.api.postgres_cache(cache)
+    async def function(mbid):
+        calls.append(mbid)
+        await release.wait()
+        return {'id': mbid, 'version': 2}, lidarrmetadata.provider.utcnow() + datetime.timedelta(days=1)
+
+    results = [await function('a') for _ in range(3)]
+
+    assert all(1 == result['version'] for result, _ in results)
+    stale_ttl = lidarrmetadata.api.CONFIG.CACHE_TTL['stale']
+    assert all(0 < (expiry - now).total_seconds() <= stale_ttl + 1 for _, expiry in results)
+    assert 1 == len(function.__inflight__)
+
+    release.set()
+    await asyncio.gather(*lidarrmetadata.api._background_refreshes)
+
+    assert ['a'] == calls
+    assert 2 == cache.items['a'][0]['version']
+    assert 2 == (await function('a'))[0]['version']
+
+
+@pytest.mark.asyncio
+async def test_postgres_cache_fetches_inline_after_grace(monkeypatch):
+    monkeypatch.setattr(lidarrmetadata.api.CONFIG, 'USE_CACHE', False)
+    monkeypatch.setattr(lidarrmetadata.api.CONFIG, 'CACHE_STALE_GRACE', 60)
+    now = lidarrmetadata.provider.utcnow()
+    cache = FakeCache({'a': ({'id': 'a', 'version': 1}, now - datetime.timedelta(seconds=120))})
+
+    @lidarrmetadata.api.postgres_cache(cache)
+    async def function(mbid):
+        return {'id': mbid, 'version': 2}, lidarrmetadata.provider.utcnow() + datetime.timedelta(days=1)
+
+    result, expiry = await function('a')
+
+    assert 2 == result['version']
+    assert expiry > now + datetime.timedelta(hours=1)
+    assert not lidarrmetadata.api._background_refreshes
+
+
+@pytest.mark.asyncio
+async def test_single_lookup_joining_batch_without_result():
+    expiry = lidarrmetadata.provider.utcnow() + datetime.timedelta(days=1)
+
+    async def multi_function(mbids):
+        await asyncio.sleep(0.01)
+        return [({'id': mbid}, expiry) for mbid in mbids if mbid != 'old']
+
+    @lidarrmetadata.api.postgres_cache(FakeCache())
+    async def function(mbid):
+        if mbid == 'old':
+            return {'id': 'new'}, expiry
+        raise lidarrmetadata.api.ArtistNotFoundException(mbid)
+
+    batch = asyncio.ensure_future(lidarrmetadata.api.get_cached_batch(function, multi_function, ['a', 'old']))
+    await asyncio.sleep(0)
+    assert 'old' in function.__inflight__
+
+    result, _ = await function('old')
+    assert 'new' == result['id']
+    assert ['a', 'new'] == [result['id'] for result, _ in await batch]
+
+
+@pytest.mark.asyncio
+async def test_iterate_artist_release_group_ids_in_chunks(monkeypatch):
+    class FakeMusicbrainz:
+        async def iterate_artist_release_group_ids(self, artist_ids):
+            for mbid in ['a', 'b', 'c']:
+                yield mbid
+
+    monkeypatch.setattr(lidarrmetadata.provider, 'get_providers_implementing', lambda mixin: [FakeMusicbrainz()])
+
+    chunks = [chunk async for chunk in lidarrmetadata.api.iterate_artist_release_group_ids(['artist'], chunk_size=2)]
+
+    assert [['a', 'b'], ['c']] == chunks
+    assert [] == [chunk async for chunk in lidarrmetadata.api.iterate_artist_release_group_ids([])]
@@ -0,0 +1,610 @@
+import asyncio
+import contextlib
+import datetime
+import marshal
+import pickle
+
+import pytest
+
+from lidarrmetadata import cache
+
+
+def _in(seconds):
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+
+class TestMemoryCache:
+    def setup_method(self, method):
+        self.cache = cache.MemoryCache(max_size=2, max_ttl=60)
+
+    def test_miss(self):
+        assert (None, None) == self.cache.get('a')
+        assert 1 == self.cache.misses
+
+    def test_hit(self):
+        expiry = _in(3600)
+        self.cache.set('a', {'id': 'a'}, expiry)
+
+        assert ({'id': 'a'}, expiry) == self.cache.get('a')
+        assert 1 == self.cache.hits
+
+    def test_expired(self):
+        self.cache.set('a', {'id': 'a'}, _in(-1))
+
+        assert (None, None) == self.cache.get('a')
+        assert 0 == len(self.cache)
+
+    def test_max_ttl(self):
+        self.cache.max_ttl = 0
+        self.cache.set('a', {'id': 'a'}, _in(3600))
+
+        assert (None, None) == self.cache.get('a')
+
+    def test_eviction(self):
+        self.cache.set('a', {'id': 'a'}, _in(3600))
+        self.cache.set('b', {'id': 'b'}, _in(3600))
+        self.cache.get('a')
+        self.cache.set('c', {'id': 'c'}, _in(3600))
+
+        assert self.cache.get('a')[0] is not None
+        assert self.cache.get('b')[0] is None
+        assert 1 == self.cache.evictions
+
+    def test_copy(self):
+        self.cache.set('a', {'id': 'a', 'artistids': []}, _in(3600))
+
+        value, _ = self.cache.get('a')
+        del value['artistids']
+
+        assert {'id': 'a', 'artistids': []} == self.cache.get('a')[0]
+
+    def test_delete(self):
+        self.cache.set('a', {'id': 'a'}, _in(3600))
+        self.cache.delete('a')
+
+        assert (None, None) == self.cache.get('a')
+
+    def test_disabled(self):
+        disabled = cache.MemoryCache(max_size=0)
+        disabled.set('a', {'id': 'a'}, _in(3600))
+
+        assert 0 == len(disabled)
+
+
+class TestSingleFlight:
+    def setup_method(self, method):
+        self.flight = cache.SingleFlight()
+        self.calls = 0
+
+    async def _work(self, value):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return value
+
+    async def _fail(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError('failed')
+
+    @pytest.mark.asyncio
+    async def test_coalesced(self):
+        results = await asyncio.gather(*[self.flight.run('a', self._work, 1) for _ in range(5)])
+
+        assert [1] * 5 == results
+        assert 1 == self.calls
+        assert 0 == len(self.flight)
+
+    @pytest.mark.asyncio
+    async def test_separate_keys(self):
+        results = await asyncio.gather(self.flight.run('a', self._work, 1),
+                                       self.flight.run('b', self._work, 2))
+
+        assert [1, 2] == results
+        assert 2 == self.calls
+
+    @pytest.mark.asyncio
+    async def test_exception_raised_to_all(self):
+        results = await asyncio.gather(*[self.flight.run('a', self._fail) for _ in range(3)],
+                                       return_exceptions=True)
+
+        assert all(isinstance(result, ValueError) for result in results)
+        assert 1 == self.calls
+
+
+class TestVersionedSerializer:
+    def setup_method(self, method):
+        self.serializer = cache.VersionedSerializer(compress_threshold=100)
+        self.value = {'id': 'a', 'aliases': ['b', 'c'], 'rating': {'Count': 1, 'Value': 9.5}, 'type': None}
+
+    def test_round_trip(self):
+        assert self.value == self.serializer.loads(self.serializer.dumps(self.value))
+
+    def test_header(self):
+        assert 0x12 == self.serializer.dumps(self.value)[0]
+
+    def test_pinned_marshal_version(self):
+        assert marshal.dumps(self.value, 4) == self.serializer.dumps(self.value)[1:]
+
+    def test_legacy_marshal(self):
+        assert self.value == self.serializer.loads(b'\x11' + marshal.dumps(self.value))
+
+    def test_compressed(self):
+        value = {'overview': 'a' * 1000}
+        dumped = self.serializer.dumps(value)
+
+        assert dumped[0] & cache.VersionedSerializer.COMPRESSED
+        assert len(dumped) < 1000
+        assert value == self.serializer.loads(dumped)
+
+    def test_pickle_fallback(self):
+        value = {'date': _in(0)}
+        dumped = self.serializer.dumps(value)
+
+        assert 0 == dumped[0] & 0x07
+        assert value == self.serializer.loads(dumped)
+
+    def test_legacy_pickle(self):
+        assert self.value == self.serializer.loads(pickle.dumps(self.value))
+
+    def test_unknown_version(self):
+        with pytest.raises(ValueError):
+            self.serializer.loads(b'\x21')
+
+    def test_none(self):
+        assert self.serializer.loads(None) is None
+
+    def test_uncompressed_by_default(self):
+        dumped = cache.VersionedSerializer().dumps({'overview': 'a' * 10000})
+
+        assert not dumped[0] & cache.VersionedSerializer.COMPRESSED
+
+
+class FakeConnection:
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.terminated = False
+
+    async def fetchval(self, query, timeout=None):
+        if self.broken:
+            raise ConnectionResetError()
+        return 1
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakePool:
+    def __init__(self, connections):
+        self.idle = list(connections)
+
+    def get_idle_size(self):
+        return len(self.idle)
+
+    async def acquire(self, timeout=None):
+        return self.idle.pop()
+
+    async def release(self, connection):
+        self.idle.append(connection)
+
+
+@pytest.mark.asyncio
+async def test_check_pool():
+    connections = [FakeConnection(), FakeConnection(broken=True)]
+    pool = FakePool(connections)
+
+    assert 1 == await cache.check_pool(pool)
+    assert [False, True] == [connection.terminated for connection in connections]
+    assert 2 == pool.get_idle_size()
+
+    assert 0 == await cache.check_pool(FakePool([FakeConnection()]))
+
+
+@pytest.mark.asyncio
+async def test_check_pool_busy():
+    assert 0 == await cache.check_pool(FakePool([]))
+
+
+@pytest.mark.asyncio
+async def test_shared_pool(monkeypatch):
+    created = []
+
+    async def create_pool(**kwargs):
+        created.append(kwargs)
+        return FakePool([])
+
+    monkeypatch.setattr(cache.asyncpg, 'create_pool', create_pool)
+    monkeypatch.setattr(cache, '_POOLS', {})
+
+    a = await cache.get_shared_pool('host', 5432, 'user', 'password', 'db', max_size=5)
+    b = await cache.get_shared_pool('host', 5432, 'user', 'password', 'db')
+    c = await cache.get_shared_pool('host', 5432, 'user', 'password', 'other')
+
+    assert a is b
+    assert a is not c
+    assert 2 == len(created)
+    assert 5 == created[0]['max_size']
+
+
+@pytest.mark.asyncio
+async def test_transaction_without_postgres():
+    async with cache.transaction(cache.NullCache()) as _conn:
+        assert _conn is None
+
+
+class FakeSweepConnection:
+    def __init__(self, counts):
+        self.counts = list(counts)
+        self.queries = 0
+
+    async def execute(self, query, *args):
+        self.queries += 1
+        return f'DELETE {self.counts.pop(0)}'
+
+
+@pytest.mark.asyncio
+async def test_sweep_expired():
+    postgres_cache = cache.PostgresCache(keep_expired=False)
+    _conn = FakeSweepConnection([10, 10, 3])
+
+    assert 23 == await postgres_cache.sweep_expired(60, batch_size=10, _conn=_conn)
+    assert 3 == _conn.queries
+
+
+@pytest.mark.asyncio
+async def test_sweep_expired_keep_expired():
+    postgres_cache = cache.PostgresCache(keep_expired=True)
+    _conn = FakeSweepConnection([10])
+
+    assert 0 == await postgres_cache.sweep_expired(60, _conn=_conn)
+    assert 0 == _conn.queries
+
+
+class FakeCopyConnection:
+    def __init__(self):
+        self.records = None
+        self.queries = []
+
+    def transaction(self):
+        @contextlib.asynccontextmanager
+        async def transaction():
+            yield
+        return transaction()
+
+    async def execute(self, query, *args):
+        self.queries.append((query, args))
+
+    async def copy_records_to_table(self, table, records):
+        self.records = records
+
+
+@pytest.mark.asyncio
+async def test_multi_set_expiring():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeCopyConnection()
+    expiries = [_in(60), _in(3600)]
+
+    await postgres_cache.multi_set_expiring([('a', {'id': 'a'}, expiries[0]), ('b', None, expiries[1])], _conn=_conn)
+
+    assert ['a', 'b'] == [key for key, _, _ in _conn.records]
+    assert expiries == [expiry for _, expiry, _ in _conn.records]
+    assert {'id': 'a'} == postgres_cache.serializer.loads((_conn.records[0][2], None))[0]
+
+
+@pytest.mark.asyncio
+async def test_multi_delete():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeCopyConnection()
+
+    await postgres_cache.multi_delete(['a', 'b'], _conn=_conn)
+
+    assert [(['a', 'b'],)] == [args for _, args in _conn.queries]
+
+
+class FakeFetchConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.args = None
+
+    async def fetch(self, query, *args):
+        self.args = args
+        return self.rows
+
+
+@pytest.mark.asyncio
+async def test_multi_get():
+    postgres_cache = cache.PostgresCache()
+    expiries = [_in(60), _in(-60)]
+    _conn = FakeFetchConnection([(postgres_cache.serializer.dumps({'id': 'b'}), expiries[0]),
+                                 (None, None),
+                                 (postgres_cache.serializer.dumps({'id': 'a'}), expiries[1])])
+
+    results = await postgres_cache.multi_get(['b', 'missing', 'a'], _conn=_conn)
+
+    assert (['b', 'missing', 'a'],) == _conn.args
+    assert [({'id': 'b'}, expiries[0]), ({'id': 'a'}, expiries[1])] == [results[0], results[2]]
+    assert results[1][0] is None
+    assert abs((results[1][1] - _in(0)).total_seconds()) < 5
+
+
+@pytest.mark.asyncio
+async def test_multi_get_empty():
+    assert [] == await cache.PostgresCache().multi_get([], _conn=FakeFetchConnection(None))
+
+
+@pytest.mark.asyncio
+async def test_null_cache_multi_get():
+    null_cache = cache.NullCache(serializer=cache.ExpirySerializer())
+
+    results = await null_cache.multi_get(['a', 'b'])
+
+    assert [None, None] == [value for value, _ in results]
+
+
+@pytest.mark.asyncio
+async def test_claim_expiring():
+    postgres_cache = cache.PostgresCache()
+    expiries = [_in(60), _in(-60)]
+    _conn = FakeFetchConnection([{'key': 'a', 'due': expiries[0]}, {'key': 'b', 'due': expiries[1]}])
+
+    assert [('b', expiries[1]), ('a', expiries[0])] == await postgres_cache.claim_expiring(10, _in(3600), 600,
+                                                                                          _conn=_conn)
+    assert 600 == _conn.args[2]
+
+
+class FakeHitCache:
+    def __init__(self):
+        self.counts = []
+
+    async def add_hits(self, counts):
+        self.counts.append(dict(counts))
+
+
+@pytest.mark.asyncio
+async def test_hit_counter(monkeypatch):
+    hit_cache = FakeHitCache()
+    counter = cache.HitCounter(hit_cache, sample_rate=0.25)
+
+    monkeypatch.setattr(cache.random, 'random', lambda: 0.1)
+    counter.record('a')
+    counter.record('a')
+    counter.record('b')
+    monkeypatch.setattr(cache.random, 'random', lambda: 0.9)
+    counter.record('c')
+
+    assert 2 == await counter.flush()
+    assert [{'a': 8, 'b': 4}] == hit_cache.counts
+    assert 0 == len(counter)
+
+
+class FailingHitCache:
+    async def add_hits(self, counts):
+        raise ConnectionError()
+
+
+@pytest.mark.asyncio
+async def test_hit_counter_flush_failure(monkeypatch):
+    counter = cache.HitCounter(FailingHitCache(), sample_rate=1)
+    monkeypatch.setattr(cache.random, 'random', lambda: 0)
+    counter.record('a')
+    counter.record('b')
+
+    with pytest.raises(ConnectionError):
+        await counter.flush()
+
+    counter.record('a')
+    counter.cache = FakeHitCache()
+    assert 2 == await counter.flush()
+    assert [{'a': 2, 'b': 1}] == counter.cache.counts
+
+
+class FakeHitConnection:
+    def __init__(self):
+        self.args = None
+
+    async def execute(self, query, *args):
+        self.args = args
+
+
+@pytest.mark.asyncio
+async def test_add_hits_sorted():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeHitConnection()
+
+    await postgres_cache.add_hits({'b': 1, 'a': 2}, _conn=_conn)
+
+    assert (['a', 'b'], [2, 1]) == _conn.args
+
+
+def test_due_filter():
+    assert ('expires', 'expires < $1') == cache.PostgresCache()._due_filter()
+
+    due, condition = cache.PostgresCache(hit_boost=60, max_hit_boost=3600)._due_filter()
+    assert 'cache_due(expires, hits, 60, 3600)' == due
+    assert f'{due} < $1' == condition
+
+
+class FakeIndexConnection:
+    def __init__(self, function=None, valid=None):
+        self.values = {'to_regprocedure': function, 'indisvalid': valid}
+        self.queries = []
+
+    async def fetchval(self, query, *args):
+        return next(value for name, value in self.values.items() if name in query)
+
+    async def execute(self, query, *args):
+        self.queries.append(query)
+
+
+@pytest.mark.asyncio
+async def test_create_due_index():
+    postgres_cache = cache.PostgresCache(db_table='artist', hit_boost=60, max_hit_boost=3600)
+    due, _ = postgres_cache._due_filter()
+
+    _conn = FakeIndexConnection()
+    await postgres_cache._create_due_index(_conn)
+    assert 'FUNCTION cache_due' in _conn.queries[0]
+    assert f'CREATE INDEX CONCURRENTLY IF NOT EXISTS artist_due_60_3600_idx ON artist ({due});' == _conn.queries[1]
+
+    _conn = FakeIndexConnection(function='cache_due', valid=True)
+    await postgres_cache._create_due_index(_conn)
+    assert [] == _conn.queries
+
+    _conn = FakeIndexConnection()
+    await cache.PostgresCache(db_table='fanart')._create_due_index(_conn)
+    assert [] == _conn.queries
+
+
+@pytest.mark.asyncio
+async def test_multi_add_expiring():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeCopyConnection()
+    expiry = _in(0)
+
+    await postgres_cache.multi_add_expiring(['a', 'b'], expiry, _conn=_conn)
+
+    assert [('a', expiry), ('b', expiry)] == [(key, expires) for key, expires, _ in _conn.records]
+    assert any('DO NOTHING' in query for query, _ in _conn.queries)
+
+
+class FakeExpireConnection(FakeCopyConnection):
+    async def execute(self, query, *args):
+        await super().execute(query, *args)
+        return 'UPDATE 1'
+
+
+@pytest.mark.asyncio
+async def test_multi_expire():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeExpireConnection()
+
+    assert 1 == await postgres_cache.multi_expire(['a', 'b'], _conn=_conn)
+
+    query, args = _conn.queries[0]
+    assert query.startswith('UPDATE') and 'value' not in query
+    assert (['a', 'b'],) == args
+    assert ['a', 'b'] == [key for key, _, _ in _conn.records]
+    assert any('DO NOTHING' in query for query, _ in _conn.queries)
+
+
+@pytest.mark.asyncio
+async def test_multi_expire_existing_only():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeExpireConnection()
+
+    await postgres_cache.multi_expire(['a'], add_missing=False, _conn=_conn)
+
+    assert 1 == len(_conn.queries)
+    assert _conn.records is None
+
+
+class FakeColumnConnection:
+    def __init__(self, columns):
+        self.columns = columns
+        self.queries = []
+
+    async def fetch(self, query, *args):
+        return [{'column_name': column} for column in self.columns]
+
+    async def execute(self, query, *args):
+        self.queries.append(query)
+
+
+@pytest.mark.asyncio
+async def test_add_missing_columns():
+    postgres_cache = cache.PostgresCache(db_table='artist')
+
+    _conn = FakeColumnConnection(['key', 'expires', 'updated', 'value'])
+    await postgres_cache._add_missing_columns(_conn)
+    assert len(cache.PostgresBackend.ADDED_COLUMNS) == len(_conn.queries)
+    assert all(query.startswith('ALTER TABLE artist ADD COLUMN') for query in _conn.queries)
+
+    _conn = FakeColumnConnection(['key', 'expires', 'updated', 'value'] + list(cache.PostgresBackend.ADDED_COLUMNS))
+    await postgres_cache._add_missing_columns(_conn)
+    assert [] == _conn.queries
+
+
+@pytest.mark.asyncio
+async def test_single_flight_run_many():
+    flight = cache.SingleFlight()
+    batches = []
+    release = asyncio.Event()
+
+    async def single(key):
+        await release.wait()
+        return key.upper()
+
+    async def many(keys):
+        batches.append(keys)
+        await release.wait()
+        return {key: key.upper() for key in keys if key != 'missing'}
+
+    running = asyncio.ensure_future(flight.run('a', single, 'a'))
+    await asyncio.sleep(0)
+    first = asyncio.ensure_future(flight.run_many(['a', 'b', 'missing'], many))
+    second = asyncio.ensure_future(flight.run_many(['b', 'c'], many))
+    await asyncio.sleep(0)
+    release.set()
+
+    assert {'a': 'A', 'b': 'B', 'missing': None} == await first
+    assert {'b': 'B', 'c': 'C'} == await second
+    assert 'A' == await running
+    assert [['b', 'missing'], ['c']] == batches
+    assert 0 == len(flight)
+
+
+@pytest.mark.asyncio
+async def test_single_flight_run_many_error():
+    flight = cache.SingleFlight()
+
+    async def many(keys):
+        raise ValueError()
+
+    results = await flight.run_many(['a', 'b'], many)
+    assert all(isinstance(result, ValueError) for result in results.values())
+    assert 0 == len(flight)
+
+
+class FakeDeleteConnection:
+    def __init__(self):
+        self.args = None
+
+    async def execute(self, query, *args):
+        self.args = args
+        return 'DELETE 2'
+
+
+@pytest.mark.asyncio
+async def test_prune_range():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeDeleteConnection()
+
+    assert 2 == await postgres_cache.prune_range('a', 'c', ['b'], _conn=_conn)
+    assert ('a', 'c', ['b']) == _conn.args
+
+    await postgres_cache.prune_range(None, None, [], _conn=_conn)
+    assert (None, None, []) == _conn.args
+
+
+class FakeMergeConnection(FakeDeleteConnection):
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    async def execute(self, query, *args):
+        self.queries.append(query)
+        return 'DELETE 2'
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+@pytest.mark.asyncio
+async def test_finish_merge():
+    postgres_cache = cache.PostgresCache()
+    _conn = FakeMergeConnection()
+    table = postgres_cache._db_table
+
+    assert 2 == await postgres_cache._finish_merge(_conn=_conn)
+    assert f"FROM {table}_merged merged" in _conn.queries[0]
+    assert f"DROP TABLE {table}_merged;" == _conn.queries[1]
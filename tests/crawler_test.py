@@ -0,0 +1,304 @@
+import asyncio
+import datetime
+
+import pytest
+
+from lidarrmetadata import crawler
+from lidarrmetadata import provider
+
+
+def _in(seconds):
+    return provider.utcnow() + datetime.timedelta(seconds=seconds)
+
+
+class FakeCache:
+    def __init__(self, expiries):
+        self.expiries = expiries
+        self.reads = 0
+
+    async def get_expiring(self, count, expires_before):
+        self.reads += 1
+        items = sorted(((key, expires) for key, expires in self.expiries.items() if expires < expires_before),
+                       key=lambda item: item[1])
+        return items[:count]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_dispatches_due_in_expiry_order():
+    cache = FakeCache({'a': _in(30), 'b': _in(-10), 'c': _in(600)})
+    scheduler = crawler.RefreshScheduler(cache, lead_time=60)
+
+    assert ['b', 'a'] == await scheduler.next_batch(10)
+    assert 2 == scheduler.in_flight
+    assert 1 == len(scheduler)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_skips_in_flight():
+    cache = FakeCache({'a': _in(-10), 'b': _in(-5)})
+    scheduler = crawler.RefreshScheduler(cache, lead_time=60)
+
+    assert ['a'] == await scheduler.next_batch(1)
+
+    await scheduler.refill()
+    assert ['b'] == await scheduler.next_batch(1)
+
+    scheduler.done(['a', 'b'])
+    assert 0 == scheduler.in_flight
+
+
+@pytest.mark.asyncio
+async def test_scheduler_refills_past_horizon():
+    cache = FakeCache({'a': _in(-30), 'b': _in(-20), 'c': _in(-10)})
+    scheduler = crawler.RefreshScheduler(cache, lead_time=60, refill_count=2)
+
+    assert ['a', 'b'] == await scheduler.next_batch(10)
+    scheduler.done(['a', 'b'])
+    del cache.expiries['a'], cache.expiries['b']
+
+    assert ['c'] == await scheduler.next_batch(10)
+    assert 2 == cache.reads
+
+
+class FakeScheduler:
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.done_keys = []
+        self._in_flight = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    async def next_batch(self, count):
+        if not self.keys:
+            await asyncio.sleep(3600)
+        keys, self.keys = self.keys[:count], self.keys[count:]
+        self._in_flight.update(keys)
+        return keys
+
+    def done(self, keys):
+        self._in_flight.difference_update(keys)
+        self.done_keys.extend(keys)
+
+
+async def _run_until_done(pipeline, scheduler, total):
+    task = asyncio.ensure_future(pipeline.run())
+    try:
+        while len(scheduler.done_keys) < total:
+            await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+
+@pytest.mark.asyncio
+async def test_pipeline_slow_key_does_not_block_others():
+    scheduler = FakeScheduler(['slow'] + [str(i) for i in range(10)])
+    release = asyncio.Event()
+
+    async def refresh(keys):
+        if keys == ['slow']:
+            await release.wait()
+
+    pipeline = crawler.RefreshPipeline('test', scheduler, refresh, concurrency=2, prefetch=4)
+    task = asyncio.ensure_future(_run_until_done(pipeline, scheduler, 11))
+
+    while len(scheduler.done_keys) < 10:
+        await asyncio.sleep(0.01)
+    assert 'slow' not in scheduler.done_keys
+    assert 1 == pipeline.stats()['busy_workers']
+
+    release.set()
+    await task
+    assert 11 == pipeline.processed
+
+
+@pytest.mark.asyncio
+async def test_pipeline_chunks_and_survives_errors():
+    scheduler = FakeScheduler(range(6))
+    chunks = []
+
+    async def refresh(keys):
+        chunks.append(keys)
+        if 0 in keys:
+            raise ValueError()
+
+    pipeline = crawler.RefreshPipeline('test', scheduler, refresh, concurrency=1, chunk_size=3, prefetch=6)
+    await _run_until_done(pipeline, scheduler, 6)
+
+    assert all(len(chunk) <= 3 for chunk in chunks)
+    assert list(range(6)) == sorted(key for chunk in chunks for key in chunk)
+    assert 3 == pipeline.failed
+    assert 0 == scheduler.in_flight
+
+
+class FakeClaimCache:
+    def __init__(self, expiries):
+        self.expiries = expiries
+        self.claimed = set()
+
+    async def claim_expiring(self, count, expires_before, lease):
+        items = sorted(((key, expires) for key, expires in self.expiries.items()
+                        if expires < expires_before and key not in self.claimed), key=lambda item: item[1])[:count]
+        self.claimed.update(key for key, _ in items)
+        return items
+
+    async def get_next_unclaimed(self, expires_before):
+        dues = [expires for key, expires in self.expiries.items()
+                if expires < expires_before and key not in self.claimed]
+        return min(dues) if dues else None
+
+
+@pytest.mark.asyncio
+async def test_leased_schedulers_split_keys():
+    cache = FakeClaimCache({'a': _in(-10), 'b': _in(-5), 'c': _in(30), 'd': _in(7200)})
+    first = crawler.LeasedRefreshScheduler(cache, lead_time=60)
+    second = crawler.LeasedRefreshScheduler(cache, lead_time=60)
+
+    assert ['a', 'b'] == await first.next_batch(2)
+    assert ['c'] == await second.next_batch(2)
+    assert 2 == first.in_flight
+
+
+@pytest.mark.asyncio
+async def test_leased_scheduler_sleeps_until_next_due(monkeypatch):
+    cache = FakeClaimCache({'a': _in(-10), 'b': _in(90)})
+    scheduler = crawler.LeasedRefreshScheduler(cache, lead_time=60, lease=600)
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        cache.expiries['b'] = _in(-10)
+
+    monkeypatch.setattr(crawler.asyncio, 'sleep', sleep)
+
+    assert ['a'] == await scheduler.next_batch(2)
+    assert ['b'] == await scheduler.next_batch(2)
+    assert 1 == len(sleeps)
+    assert 25 < sleeps[0] <= 30
+
+
+@pytest.mark.asyncio
+async def test_leased_scheduler_sleeps_at_most_a_lease(monkeypatch):
+    cache = FakeClaimCache({'a': _in(7200)})
+    scheduler = crawler.LeasedRefreshScheduler(cache, lead_time=60, lease=600)
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        cache.expiries['a'] = _in(-10)
+
+    monkeypatch.setattr(crawler.asyncio, 'sleep', sleep)
+
+    assert ['a'] == await scheduler.next_batch(2)
+    assert 595 < sleeps[0] <= 600
+
+
+def test_summarize_progress():
+    latest = {(1, 'artist'): {'processed': 10, 'throughput': 1.5},
+              (2, 'artist'): {'processed': 5, 'throughput': 0.5},
+              (1, 'fanart'): {'processed': 3, 'throughput': 0.1}}
+
+    totals = crawler.summarize_progress(latest)
+
+    assert {'processed': 15, 'throughput': 2.0} == totals['artist']
+    assert 3 == totals['fanart']['processed']
+
+
+class FakeInitializeCache:
+    def __init__(self, keys=(), checkpoint=None):
+        self.keys = set(keys)
+        self.checkpoints = {'initialize_test': checkpoint}
+
+    async def multi_add_expiring(self, keys, expiry, _conn=None):
+        new = set(keys) - self.keys
+        self.keys.update(new)
+        return len(new)
+
+    async def prune_range(self, after, until, keep, _conn=None):
+        removed = {key for key in self.keys
+                   if (after is None or key > after) and (until is None or key <= until) and key not in keep}
+        self.keys -= removed
+        return len(removed)
+
+    async def get_checkpoint(self, name):
+        return self.checkpoints.get(name)
+
+    async def set_checkpoint(self, name, value, _conn=None):
+        self.checkpoints[name] = value
+
+
+def _get_ids(ids, pages):
+    async def get_ids(after, limit):
+        pages.append(after)
+        return [item for item in ids if item > after][:limit]
+    return get_ids
+
+
+@pytest.mark.asyncio
+async def test_initialize_keys_merges_in_pages():
+    cache = FakeInitializeCache(keys=['0', 'b', 'bb', 'd', 'old'])
+    pages = []
+
+    await crawler.initialize_keys(cache, _get_ids(['a', 'b', 'c', 'd', 'e'], pages), 'test', chunk_size=2)
+
+    assert {'a', 'b', 'c', 'd', 'e'} == cache.keys
+    assert [crawler.MIN_MBID, 'b', 'd', 'e'] == pages
+    assert cache.checkpoints['initialize_test'] is None
+
+
+@pytest.mark.asyncio
+async def test_initialize_keys_resumes_from_checkpoint():
+    cache = FakeInitializeCache(keys=['a', 'cc'], checkpoint='c')
+    pages = []
+
+    await crawler.initialize_keys(cache, _get_ids(['a', 'b', 'c', 'd', 'e'], pages), 'test', chunk_size=10)
+
+    assert {'a', 'd', 'e'} == cache.keys
+    assert 'c' == pages[0]
+
+
+class FakeMergeCache:
+    def __init__(self, values):
+        self.values = dict(values)
+        self.merged = None
+        self.served = []
+
+    async def start_merge(self):
+        self.merged = set()
+
+    async def merge(self, pairs, ttl=None):
+        # Existing maps must still be there while the load runs
+        self.served.append('old' in self.values)
+        self.values.update(pairs)
+        self.merged.update(key for key, _ in pairs)
+
+    async def finish_merge(self):
+        removed = set(self.values) - self.merged
+        for key in removed:
+            del self.values[key]
+        return len(removed)
+
+
+class FakeSpotifyProvider:
+    async def get_all_spotify_mappings(self):
+        for spotifyid, mbid in [('s1', 'a'), ('s2', 'b'), ('s3', 'c')]:
+            yield {'spotifyid': spotifyid, 'mbid': mbid}
+
+
+@pytest.mark.asyncio
+async def test_initialize_spotify_merges_in_chunks(monkeypatch):
+    spotify_cache = FakeMergeCache({'old': 'x', 's1': 'z'})
+    monkeypatch.setattr(crawler.util, 'SPOTIFY_CACHE', spotify_cache)
+    monkeypatch.setattr(crawler.provider, 'get_providers_implementing', lambda mixin: [FakeSpotifyProvider()])
+    monkeypatch.setattr(crawler.CONFIG, 'CRAWLER_INITIALIZE_CHUNK_SIZE', 2)
+
+    await crawler.initialize_spotify()
+
+    assert {'s1': 'a', 's2': 'b', 's3': 'c'} == spotify_cache.values
+    assert [True, True] == spotify_cache.served
@@ -0,0 +1,175 @@
+import asyncio
+import contextlib
+
+import pytest
+
+from lidarrmetadata import invalidation
+
+
+class FakeMusicbrainz:
+    def __init__(self, artists=None, albums=None):
+        self.artists = artists or {}
+        self.albums = albums or {}
+        self.queries = []
+
+    async def get_changed_entities(self, table, ids):
+        self.queries.append((table, ids))
+        return ([gid for id in ids for gid in self.artists.get((table, id), [])],
+                [gid for id in ids for gid in self.albums.get((table, id), [])])
+
+
+def test_parse_change():
+    change = invalidation.parse_change(b'{"_table": "musicbrainz.release", "id": 5}')
+
+    assert ('release', 5, None) == change[:3]
+    assert invalidation.parse_change(b'not json') is None
+    assert invalidation.parse_change(b'{"id": 5}') is None
+
+
+@pytest.mark.asyncio
+async def test_resolve_changes():
+    musicbrainz = FakeMusicbrainz(artists={('release', 1): ['artist1']},
+                                  albums={('release', 1): ['album1'], ('release_group', 2): ['album1']})
+    queue = invalidation.LocalChangeQueue()
+    consumer = invalidation.ChangeConsumer(queue, musicbrainz)
+
+    changes = [invalidation.Change('release', 1, None, None),
+               invalidation.Change('release', 1, None, None),
+               invalidation.Change('release_group', 2, None, None),
+               invalidation.Change('track', 5, None, None),
+               invalidation.Change('artist', 3, 'deleted', None),
+               invalidation.Change('editor', 4, None, None)]
+    artists, albums = await consumer.resolve(changes)
+
+    assert {'artist1', 'deleted'} == artists
+    assert {'album1'} == albums
+    assert [('release', [1]), ('release_group', [2])] == sorted(musicbrainz.queries)
+
+
+@pytest.mark.asyncio
+async def test_consumer_batches_and_acks(monkeypatch):
+    expired = []
+
+    async def expire_entities(artists, albums):
+        expired.append((artists, albums))
+
+    monkeypatch.setattr(invalidation, 'expire_entities', expire_entities)
+
+    queue = invalidation.LocalChangeQueue()
+    consumer = invalidation.ChangeConsumer(queue, FakeMusicbrainz(albums={('release_group', 1): ['album1']}),
+                                           batch_size=10, batch_interval=0.05)
+    queue.publish('release_group', id=1)
+    queue.publish('artist', gid='artist1')
+
+    task = asyncio.ensure_future(consumer.run())
+    await asyncio.wait_for(queue.join(), 1)
+    task.cancel()
+
+    assert [({'artist1'}, {'album1'})] == expired
+
+
+@pytest.mark.asyncio
+async def test_consumer_retries_failed_batch(monkeypatch):
+    calls = []
+
+    async def expire_entities(artists, albums):
+        calls.append(artists)
+        if len(calls) == 1:
+            raise ConnectionError()
+
+    monkeypatch.setattr(invalidation, 'expire_entities', expire_entities)
+
+    queue = invalidation.LocalChangeQueue()
+    consumer = invalidation.ChangeConsumer(queue, FakeMusicbrainz(), batch_interval=0.01, retry_delay=0)
+    queue.publish('artist', gid='artist1')
+
+    task = asyncio.ensure_future(consumer.run())
+    await asyncio.wait_for(queue.join(), 1)
+    task.cancel()
+
+    assert [{'artist1'}, {'artist1'}] == calls
+
+
+class FakeExpireCache:
+    def __init__(self):
+        self.expired = []
+
+    async def multi_expire(self, keys, add_missing=True, _conn=None):
+        self.expired.append((sorted(keys), add_missing))
+        return len(keys)
+
+    async def multi_set(self, pairs, ttl=None, timeout=None, _conn=None):
+        self.expired.append((sorted(pairs), ttl))
+
+
+@pytest.mark.asyncio
+async def test_expire_entities(monkeypatch):
+    caches = {name: FakeExpireCache() for name in ('ARTIST_CACHE', 'ALBUM_CACHE', 'SPOTIFY_CACHE', 'RESPONSE_CACHE')}
+    for name, fake in caches.items():
+        monkeypatch.setattr(invalidation.util, name, fake)
+
+    @contextlib.asynccontextmanager
+    async def transaction(*caches):
+        yield None
+
+    async def iterate_artist_release_group_ids(artists):
+        assert {'artist1'} == artists
+        yield ['album2', 'album3']
+        yield ['album4']
+
+    monkeypatch.setattr(invalidation.cache, 'transaction', transaction)
+    monkeypatch.setattr(invalidation.api, 'iterate_artist_release_group_ids', iterate_artist_release_group_ids)
+    monkeypatch.setattr(invalidation.api, 'response_key', lambda path: path)
+
+    await invalidation.expire_entities({'artist1'}, {'album1'}, spotify_albums=['spotify1'])
+
+    assert [(['artist1'], True)] == caches['ARTIST_CACHE'].expired
+    assert [(['album1'], True)] == caches['ALBUM_CACHE'].expired
+    assert [([('spotify1', None)], 0)] == caches['SPOTIFY_CACHE'].expired
+    assert [(['/album/album1', '/artist/artist1'], False),
+            (['/album/album2', '/album/album3'], False),
+            (['/album/album4'], False)] == caches['RESPONSE_CACHE'].expired
+
+
+@pytest.mark.asyncio
+async def test_consume_changes_retries(monkeypatch):
+    events = []
+
+    class FakeAmqpQueue:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def connect(self):
+            events.append('connect')
+            if events.count('connect') == 1:
+                raise ConnectionError()
+
+        async def close(self):
+            events.append('close')
+
+    async def run(self):
+        events.append('run')
+        raise ConnectionError()
+
+    async def sleep(delay):
+        events.append(delay)
+        if len(events) > 8:
+            raise asyncio.CancelledError()
+
+    monkeypatch.setattr(invalidation, 'aio_pika', object())
+    monkeypatch.setattr(invalidation, 'AmqpChangeQueue', FakeAmqpQueue)
+    monkeypatch.setattr(invalidation.ChangeConsumer, 'run', run)
+    monkeypatch.setattr(invalidation.provider, 'get_providers_implementing', lambda cls: [FakeMusicbrainz()])
+    monkeypatch.setattr(invalidation.asyncio, 'sleep', sleep)
+
+    with pytest.raises(asyncio.CancelledError):
+        await invalidation.consume_changes(retry_delay=1)
+
+    assert ['connect', 'close', 1, 'connect', 'run', 'close', 1, 'connect', 'run'] == events[:9]
+
+
+@pytest.mark.asyncio
+async def test_consume_changes_without_aio_pika(monkeypatch):
+    monkeypatch.setattr(invalidation, 'aio_pika', None)
+
+    await invalidation.consume_changes()
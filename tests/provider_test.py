@@ -1,6 +1,10 @@
 # coding=utf-8
+import contextlib
+import re
+
 import pytest
 
+from lidarrmetadata import cache
 from lidarrmetadata import provider
 
 
@@ -39,3 +43,215 @@ class TestWikipediaProvider:
     async def test_summary_from_url(self, url, expected):
         result, expiry = await self.provider.get_artist_overview(url)
         assert result.startswith(expected)
+
+
+def test_musicbrainz_db_queries_loaded():
+    queries = provider.MusicbrainzDbProvider._load_queries()
+
+    assert 'artist_by_id.sql' in queries
+    assert 'release_group_by_id.sql' in queries
+    assert all(query.strip() for query in queries.values())
+
+
+# Link types the SQL should derive from each url's domain
+LINK_TYPES = [
+    ('https://www.discogs.com/artist/1', 'discogs'),
+    ('https://open.spotify.com/artist/abc', 'spotify'),
+    ('https://en.wikipedia.org/wiki/Blur_(band)', 'wikipedia'),
+    ('https://www.bbc.co.uk/music/artists/123', 'bbc'),
+    ('http://bbc.co.uk/music', 'bbc'),
+    ('https://co.uk/', 'co.uk'),
+    ('http://localhost/path', 'localhost'),
+    ('http://192.168.0.1/path', '0'),
+    ('https://example.com', 'example'),
+]
+
+LINK_DOMAIN_SQL = ("CROSS JOIN LATERAL split_part(url.url, '/', 3) AS url_domain "
+                   "CROSS JOIN LATERAL string_to_array(url_domain, '.') AS labels")
+
+
+def link_type_case(sql_file):
+    query = provider.MusicbrainzDbProvider._load_queries()[sql_file]
+    return ' '.join(re.search(r"'type', (CASE.*?END)", query, re.DOTALL).group(1).split())
+
+
+@pytest.mark.parametrize('sql_file', ['artist_by_id.sql', 'release_group_by_id.sql'])
+def test_musicbrainz_db_link_type_shared(sql_file):
+    query = ' '.join(provider.MusicbrainzDbProvider._load_queries()[sql_file].split())
+
+    assert LINK_DOMAIN_SQL in query
+    assert link_type_case('artist_by_id.sql') == link_type_case(sql_file)
+
+
+@pytest.mark.asyncio
+async def test_musicbrainz_db_link_type():
+    db = provider.MusicbrainzDbProvider()
+    try:
+        pool = await db._get_pool()
+    except OSError:
+        pytest.skip('No MusicBrainz database available')
+
+    urls = [url for url, _ in LINK_TYPES]
+    rows = await pool.fetch(f"SELECT url.url, {link_type_case('artist_by_id.sql')} AS type "
+                            f"FROM unnest($1::text[]) WITH ORDINALITY AS url(url, position) {LINK_DOMAIN_SQL} "
+                            "ORDER BY url.position;", urls)
+
+    assert LINK_TYPES == [(row['url'], row['type']) for row in rows]
+
+
+def caa_images(images):
+    """
+    How album images were picked in Python before the SQL built them: the first image of
+    each type in ordering, listed in the order they were found
+    """
+    type_mapping = {'Front': 'Cover', 'Medium': 'Disc'}
+    art = {}
+    for image in sorted(images, key=lambda image: (image['ordering'], image['id'])):
+        for image_type in image['types']:
+            cover_type = type_mapping.get(image_type)
+            if cover_type is not None and cover_type not in art:
+                art[cover_type] = image['id']
+    return list(art.items())
+
+
+def distinct_on_images(images):
+    """
+    Python model of the DISTINCT ON subquery in release_group_by_id.sql and the ordering of its json_agg
+    """
+    type_mapping = {'Front': 'Cover', 'Medium': 'Disc'}
+    rows = [(type_mapping[image_type], image['ordering'], image['id'], position)
+            for image in images
+            for position, image_type in enumerate(image['types'], 1)
+            if image_type in type_mapping]
+
+    first = {}
+    for row in sorted(rows, key=lambda row: (row[0], row[1], row[2])):
+        first.setdefault(row[0], row)
+    return [(cover_type, image_id) for cover_type, _, image_id, _ in
+            sorted(first.values(), key=lambda row: (row[1], row[2], row[3]))]
+
+
+def test_musicbrainz_db_image_query():
+    query = provider.MusicbrainzDbProvider._load_queries()['release_group_by_id.sql']
+    query = ' '.join(query.split())
+
+    assert 'SELECT DISTINCT ON (cover_type)' in query
+    assert 'ORDER BY cover_type, index_listing.ordering ASC, index_listing.id ASC' in query
+    assert 'ORDER BY ordering, image_id, type_position' in query
+    assert 'unnest(index_listing.types) WITH ORDINALITY AS image_type(type, position)' in query
+
+
+@pytest.mark.parametrize('images', [
+    [],
+    [{'id': 1, 'ordering': 1, 'types': ['Front']}, {'id': 2, 'ordering': 2, 'types': ['Front']}],
+    [{'id': 1, 'ordering': 2, 'types': ['Front']}, {'id': 2, 'ordering': 1, 'types': ['Medium']}],
+    [{'id': 1, 'ordering': 1, 'types': ['Back', 'Medium', 'Front']}],
+    [{'id': 3, 'ordering': 1, 'types': ['Front']}, {'id': 2, 'ordering': 1, 'types': ['Front', 'Medium']}],
+    [{'id': 1, 'ordering': 1, 'types': ['Booklet']}, {'id': 2, 'ordering': 5, 'types': ['Medium', 'Front']}],
+])
+def test_musicbrainz_db_image_choice(images):
+    assert caa_images(images) == distinct_on_images(images)
+
+
+class RecordingCache:
+    def __init__(self):
+        self.pairs = []
+        self.expired = []
+
+    async def multi_set(self, pairs, ttl=None):
+        self.pairs.append(pairs)
+
+    async def expire(self, key, ttl):
+        self.expired.append(key)
+
+
+@pytest.mark.asyncio
+async def test_fanart_refresh_images_batch(monkeypatch):
+    fanart = provider.FanArtTvProvider('key')
+    cache = RecordingCache()
+    monkeypatch.setattr(provider.util, 'FANART_CACHE', cache)
+
+    responses = {
+        'artist1': {'mbid_id': 'artist1', 'albums': {'album1': {'albumcover': []}, 'album2': {}}},
+        'artist2': {'mbid_id': 'artist2', 'albums': {'album2': {'cdart': []}}},
+    }
+
+    async def get_by_mbid(mbid):
+        if mbid not in responses:
+            raise provider.ProviderUnavailableException('unavailable')
+        return responses[mbid]
+
+    monkeypatch.setattr(fanart, 'get_by_mbid', get_by_mbid)
+
+    await fanart.refresh_images_batch(['artist1', 'artist2', 'missing'])
+
+    assert 1 == len(cache.pairs)
+    assert {'artist1', 'artist2', 'album1', 'album2'} == {key for key, _ in cache.pairs[0]}
+    assert ['missing'] == cache.expired
+
+
+class FakeCursorConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.prefetch = None
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def _cursor(self):
+        for row in self.rows:
+            yield row
+
+    def cursor(self, sql, *args, prefetch=None):
+        self.prefetch = prefetch
+        return self._cursor()
+
+
+class FakeCursorPool:
+    def __init__(self, connection):
+        self.connection = connection
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self.connection
+
+
+@pytest.mark.asyncio
+async def test_musicbrainz_db_iterate_query(monkeypatch):
+    monkeypatch.setattr(provider.Provider, 'providers', [])
+    musicbrainz = provider.MusicbrainzDbProvider()
+    connection = FakeCursorConnection([{'gid': 'a'}, {'gid': 'b'}])
+
+    async def get_pool():
+        return FakeCursorPool(connection)
+
+    monkeypatch.setattr(musicbrainz, '_get_pool', get_pool)
+
+    assert [{'gid': 'a'}, {'gid': 'b'}] == [row async for row in musicbrainz.get_all_spotify_mappings()]
+    assert provider.CONFIG.MB_DB_CURSOR_PREFETCH == connection.prefetch
+
+
+@pytest.mark.asyncio
+async def test_musicbrainz_db_invalidate_cache(monkeypatch):
+    monkeypatch.setattr(provider.Provider, 'providers', [])
+    musicbrainz = provider.MusicbrainzDbProvider()
+    rows = {'updated_artists.sql': [{'gid': 'a'}, {'gid': 'a'}, {'gid': 'b'}],
+            'updated_albums.sql': [{'gid': 'c'}],
+            'updated_spotify_artists.sql': [{'spotifyid': 'd'}],
+            'updated_spotify_albums.sql': []}
+
+    async def data_vintage():
+        return 2
+
+    async def iterate_query_from_file(sql_file, *args):
+        for row in rows[sql_file]:
+            yield row
+
+    monkeypatch.setattr(musicbrainz, 'data_vintage', data_vintage)
+    monkeypatch.setattr(musicbrainz, 'iterate_query_from_file', iterate_query_from_file)
+    monkeypatch.setattr(provider.util, 'CACHE', cache.NullCache())
+
+    result = await musicbrainz.invalidate_cache('prefix', 1)
+
+    assert {'artists': {'a', 'b'}, 'albums': {'c'}, 'spotify_artists': {'d'}, 'spotify_albums': set()} == result
@@ -1,3 +1,5 @@
+import datetime
+import json
 import unittest
 
 import pytest
@@ -14,3 +16,22 @@ from lidarrmetadata import util
 ])
 def test_first_key_item(dictionary, key, default, expected):
     assert expected == util.first_key_item(dictionary, key, default)
+
+
+@pytest.mark.parametrize('value', [
+    {'b': 1, 'a': [None, True, 1.5]},
+    {'name': 'Motörhead', 'nested': {'z': [], 'y': {}}},
+    ['a', 'b'],
+])
+def test_json_round_trip(value):
+    assert value == util.json_loads(util.json_dumps(value))
+
+
+def test_json_dumps_sorted_compact():
+    assert b'{"a":1,"b":[1,2]}' == util.json_dumps({'b': [1, 2], 'a': 1})
+
+
+def test_json_encoder_dates():
+    value = {'since': datetime.datetime(2020, 1, 2, 3, 4, 5)}
+
+    assert '{"since":"Thu, 02 Jan 2020 03:04:05 GMT"}' == json.dumps(value, cls=util.JSONEncoder, sort_keys=True)